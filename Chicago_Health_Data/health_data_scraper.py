@@ -18,44 +18,192 @@ import pandas as pd
 import bs4
 import time
 from selenium import webdriver
+from selenium.common.exceptions import WebDriverException, TimeoutException
+from selenium.webdriver.support.ui import WebDriverWait
 import gc
+import os
+import sys
+import threading
+import multiprocessing
+import multiprocessing.util
+import argparse
+import json
+import random
+import requests
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-data_dict = {'community name': []} #dictionary we will fill in
+#page_cache is shared with the CPS scraper, so we add its folder to the places Python looks for modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Chicago_Public_Schools'))
+import page_cache
+
+#Every number we scrape is saved as one (community name, metric, field, year, value) record
+#metric is the name of the table row, field is whose number it is (the table column: Community or Chicago),
+#and year is the period the number is for (the Year column before it on the page)
+long_cols = ['community name', 'metric', 'field', 'year', 'value']
 
 #This is the pathway to ChromeDriver on my machine. You will need to update this path to match where ChromeDriver is on your machine
 chrome_path = 'C:/Users/eespu/AppData/Local/Programs/Python/Python37/Lib/site-packages/selenium/webdriver/chrome/chromedriver'
 
 starting_url = 'https://www.chicagohealthatlas.org/community-areas' #URL with links to community area pages
 
-def go(url=starting_url):
+#The tables on the Health Atlas pages are filled in from these JSON data endpoints, go_api calls them directly without Chrome
+#Change api_url to point at a different server (e.g. a local copy serving saved responses)
+api_url = 'https://www.chicagohealthatlas.org/api/v1/'
+api_layer = 'neighborhood' #the Health Atlas name for community areas
+api_workers = 8 #the number of endpoints we request at the same time
+api_retries = 3 #the number of times we try an endpoint again after an error
+#go_api saves to its own CSVs, since its metrics are named after the endpoint's topics and it has no Chicago numbers
+api_csv = 'chicago_health_data_api.csv'
+api_long_csv = 'chicago_health_data_api_long.csv'
+
+#Chrome is started once and reused for many pages instead of once per page
+pool_size = 1 #the most Chrome browsers open at the same time (in each process if go uses more than one)
+pages_per_browser = 25 #a browser is closed and replaced after this many pages so it does not slowly use more and more memory
+scrape_workers = 2 #the number of worker processes (each with its own Chrome) python health_data_scraper.py uses, keep this small
+browser_pool = None #created the first time a page is loaded, see get_pool
+
+#Instead of sleeping a fixed time, we wait until the page says it is ready
+load_timeout = 20 #the most seconds to wait for a page or its tables to load
+idle_time = 0.5 #the page has stopped loading when it has not requested anything new for this many seconds
+wait_times = {} #url: how many seconds each wait took on that page, saved to health_page_waits.csv
+
+#The sections that need expanded have this exact class, clicking all of them at once runs this script
+expand_script = '''
+var clicked = 0;
+document.querySelectorAll('[aria-hidden]').forEach(function (a) {
+    if (a.getAttribute('class') === 'fa fa-caret-down txt-color-charade') { a.click(); clicked++; }
+});
+return clicked;
+'''
+#True once every section on the page has at least one cell in its table
+tables_script = '''
+var panels = document.querySelectorAll('div.c-panel__content');
+for (var i = 0; i < panels.length; i++) {
+    if (!panels[i].querySelector('td.c-table__cell')) { return false; }
+}
+return panels.length > 0;
+'''
+
+def go(url=starting_url, workers=1):
     '''
     Goes from beginning to end of web scraper
     
-    Inputs: the beginning website you want to use
+    Inputs:
+        url: the beginning website you want to use
+        workers: the number of processes scraping community pages at the same time, each with its own Chrome
     '''
     soup = create_soup(url, False)
     url_lst = find_links(soup) #gets the list of urls of the community pages
-    default = []
-    for index, url in enumerate(url_lst):
-        scrape_page(url, default) #scrapes the community's page
-        for key, lst in data_dict.items(): #makes sure that all data is filled in
-            if len(lst) < index + 1:
-                data_dict[key].append('Not Listed')
-        default.append('Not Listed') #generates list to make sure all previous data is filled in if a new metric appears on a later page
+    records = [] #the long-format records of every community
+    for url, result, waits in scrape_all(url_lst, workers):
+        add_result(result, records) #adds the community's data to records
+        wait_times[url] = waits
     
-    df = pd.DataFrame(data=data_dict) #creates a pandas dataframe from the dictionary
+    long_df = pd.DataFrame.from_records(records, columns=long_cols)
+    long_df.to_csv('chicago_health_data_long.csv', index=False) #one row for every number we scraped
+    df = to_wide(long_df) #one row for every community and one column for every metric
     df.to_csv('chicago_health_data.csv') #turns our pandas dataframe into a csv
+    pd.DataFrame.from_dict(wait_times, orient='index').to_csv('health_page_waits.csv') #how long each page took to be ready
     
-    delete_lst([soup, df, url_lst, url, default, key, lst])
+    delete_lst([soup, df, long_df, records, url_lst])
     gc.collect()
+
+def to_wide(long_df):
+    '''
+    Turns the long-format records into a table with one row for every community and one column for every metric,
+    named the same way as before: field + " " + metric (e.g. "Community Obesity"), with each number's year in the
+    column before it, named Year<n> + " " + metric (Year1 for the metric's first number with a year, Year2 for the second)
+    Columns are in the order they were first seen and metrics a community does not have are 'Not Listed'
+
+    Inputs: long_df: a pandas dataframe with the long_cols
+
+    Returns: a pandas dataframe
+    '''
+    #a metric that shows up twice on a page keeps its last value
+    long_df = long_df.drop_duplicates(['community name', 'metric', 'field'], keep='last').reset_index(drop=True)
+    values = long_df.assign(column=long_df['field'] + ' ' + long_df['metric'], cell=long_df['value'], order=2 * long_df.index + 1)
+    years = long_df[long_df['year'].notna()]
+    year_num = years.groupby(['community name', 'metric']).cumcount() + 1
+    years = years.assign(column='Year' + year_num.astype(str) + ' ' + years['metric'], cell=years['year'], order=2 * years.index)
+    cells = pd.concat([years, values]).sort_values('order') #each year goes just before its number
+
+    wide = cells.pivot(index='community name', columns='column', values='cell')
+    wide = wide.reindex(index=pd.unique(cells['community name']), columns=pd.unique(cells['column']))
+    wide = wide.fillna('Not Listed').rename_axis(index='community name', columns=None).reset_index()
+    return wide
+
+def scrape_all(url_lst, workers):
+    '''
+    Scrapes every community page, spreading the pages across worker processes if workers is more than 1
+    The results come back in the same order as url_lst no matter which worker finished first
+
+    Inputs:
+        url_lst: a list of community page urls
+        workers: the number of processes to use
+
+    Returns: a generator of (url, result from scrape_page, wait times) in the same order as url_lst
+    '''
+    if workers <= 1:
+        for url in url_lst:
+            yield scrape_worker(url)
+        return
+
+    close_pool() #the workers are forked from this process, so they must not get the Chrome go used for the first page
+    pool = multiprocessing.Pool(processes=workers, initializer=start_worker)
+    try:
+        for item in pool.imap(scrape_worker, url_lst):
+            yield item
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    pool.join() #lets every worker close its Chrome before it exits
+
+def start_worker():
+    '''
+    Runs once in each worker process, it gives the worker its own BrowserPool
+    and makes sure the worker's Chrome is closed when the worker exits
+    '''
+    global browser_pool
+    browser_pool = None #a forked worker starts with a copy of this process's pool, which it must not use or close
+    multiprocessing.util.Finalize(None, close_pool, exitpriority=10)
+    multiprocessing.util.Finalize(None, page_cache.flush, exitpriority=5) #workers exit without running atexit
+
+def scrape_worker(url):
+    '''
+    Scrapes one community page, this is what each worker process runs
+
+    Inputs: url: the url for a community page
+
+    Returns: (url, result from scrape_page, how long each wait took on the page)
+    '''
+    result = scrape_page(url)
+    return url, result, wait_times.pop(url, {})
+
+def add_result(result, records):
+    '''
+    Adds one community's data to the long-format records
+
+    Inputs:
+        result: what scrape_page returned for the community
+        records: the list of (community name, metric, field, year, value) records
+    '''
+    if result is None: #there was no data on the page
+        return None
+    community_name, rows = result
+    records.extend((community_name, metric, field, year, value) for metric, field, year, value in rows)
     
-def scrape_page(url, default):
+def scrape_page(url):
     '''
     Scrapes a single page for its health data
     
     Inputs: 
     url: the url for a community page
-    default: the default list for a newly-created dictionary item
+
+    Returns: (the community name, a list of (metric, field, year, value)) or None if there is no data on the page
+        year is None for a number that has no Year column before it
     '''
     soup = create_soup(url, True)
 
@@ -63,37 +211,32 @@ def scrape_page(url, default):
     if community_name is None: #checks if there is data on the page
         return None
     community_name = community_name.get_text()
-    data_dict['community name'].append(community_name)
+    rows = []
     
     for table in soup.find_all('div', class_="c-panel__content"): #finds all the tables on the page
         col_names = []
-        year = 1
         for column in table.find_all('th', class_="c-table__cell"): #finds all the column names
             col_n = column.get_text()
             if col_n == community_name:
                 col_n = "Community" #puts all of the community information into one column instead of different columns for every community
-            if col_n == "Year":
-                col_n = col_n + str(year) #differentiates between the two different year columns
-                year += 1
             col_names.append(col_n)
         col_names = col_names[1:] #takes out the first entry in col_names because the first column has no data in it
 
         for row in table.find_all('tr'): #the section with the information we want
-            count = -1
-            specific_names = []
-            for cell in row.find_all('td', class_="c-table__cell"): #finds all the row names and the data
+            metric, year = None, None
+            for count, cell in enumerate(row.find_all('td', class_="c-table__cell")): #finds all the row names and the data
                 text = cell.get_text()
-                if count < 0:
-                    for name in col_names: #creates the names for the dictionary fields
-                        specific_names.append(name + " " + text)
-                else:
-                    col = specific_names[count] #the name of the column will have the same index as the count
-                    col_lst = data_dict.get(col, default[:]) #gets the current dictionary list, if there is no list, gives us the default values
-                    col_lst.append(text) #adds the data to the list
-                    data_dict[col] = col_lst #sets the dictionary value
-                count += 1
-
-    delete_lst([soup, community_name, table, column, col_n, col_names, row, count, specific_names, cell, text, col, col_lst])
+                if count == 0:
+                    metric = text #the first cell is the name of the row
+                elif count <= len(col_names):
+                    field = col_names[count - 1] #the field will have the same index as the cell
+                    if field == "Year":
+                        year = text #the year of the numbers in the columns after it
+                    else:
+                        rows.append((metric, field, year, text))
+                    
+    delete_lst([soup])
+    return community_name, rows
 
 
 def find_links(soup):
@@ -117,22 +260,340 @@ def create_soup(url, expand):
         url: the url you want to scrape
         expand: if there are sections in the web page that need expanding: True for community pages, false for the first page with links to community pages
     
+    Pages are saved by page_cache, so running the scraper again does not need to load them in Chrome again
+
     Returns: a BeautifulSoup object
     '''
-    browser = webdriver.Chrome(chrome_path) #create a web driver
-    browser.get(url) #loads the website onto the driver
-    time.sleep(2) #waits 2 seconds for the page to load
-    if expand:
-        aria = browser.find_elements_by_xpath('//*[@aria-hidden]') #finds all the sections that need expanded
-        for a in aria:
-            if a.get_attribute('class') == 'fa fa-caret-down txt-color-charade':
-                a.click() #clicks on the portion that needs expanded
-                time.sleep(2) #waits 2 seconds for table to load
-    htmlSource = browser.page_source #gets the page source from the web page
-    del browser
+    htmlSource = page_cache.get_rendered(url + ('#expanded' if expand else ''), lambda: render_page(url, expand))
+    if htmlSource is None: #the page did not finish loading (it is not saved), or page_cache.offline is True and it was never saved
+        htmlSource = ''
 
     return bs4.BeautifulSoup(htmlSource, features="html.parser") #returns a BeautifulSoup object
 
+def render_page(url, expand):
+    '''
+    Loads a page in Chrome so its tables are filled in
+
+    Inputs:
+        url: the url you want to scrape
+        expand: if there are sections in the web page that need expanding
+
+    Returns: the page source, or None if the page or its tables did not load in time
+        (so page_cache does not save a half-loaded page)
+    '''
+    waits = {}
+    with get_pool().browser() as browser: #borrows a browser that is already open
+        browser.get(url) #loads the website onto the driver
+        #waits for the links (first page) or the title (community pages) and for the page to stop loading
+        ready = 'h1.t-main-title' if expand else 'a.c-simple-list__link'
+        waits['load'] = timed_wait(browser, lambda b: b.find_elements_by_css_selector(ready))
+        waits['load idle'] = timed_wait(browser, network_idle())
+        if expand:
+            if browser.execute_script(expand_script) > 0: #clicks on every portion that needs expanded at once
+                waits['tables'] = timed_wait(browser, lambda b: b.execute_script(tables_script))
+                waits['tables idle'] = timed_wait(browser, network_idle())
+        htmlSource = browser.page_source #gets the page source from the web page
+    wait_times[url] = waits
+
+    if waits['load'] is None or ('tables' in waits and waits['tables'] is None):
+        print('Skipping %s, it did not load within %s seconds' %(url, load_timeout))
+        return None
+    return htmlSource
+
+def timed_wait(browser, condition, timeout=load_timeout):
+    '''
+    Waits until condition is true or timeout seconds have passed
+
+    Inputs:
+        browser: a selenium web driver
+        condition: a function that takes the browser and returns something true when the page is ready
+        timeout: the most seconds to wait
+
+    Returns: the number of seconds we waited, or None if the page was never ready
+    '''
+    start = time.monotonic()
+    try:
+        WebDriverWait(browser, timeout, poll_frequency=0.1).until(condition)
+    except TimeoutException:
+        return None
+    return round(time.monotonic() - start, 2)
+
+def network_idle(idle=idle_time):
+    '''
+    Creates a condition that is true once the page has finished loading and has not requested anything new for idle seconds
+
+    Inputs: idle: the number of seconds without new requests
+
+    Returns: a function that takes the browser and returns True when the page is idle
+    '''
+    last = {'count': None, 'since': time.monotonic()}
+
+    def check(browser):
+        count = browser.execute_script(
+            "return document.readyState === 'complete' ? performance.getEntriesByType('resource').length : -1")
+        now = time.monotonic()
+        if count != last['count']: #something new was requested, so we start counting again
+            last['count'] = count
+            last['since'] = now
+            return False
+        return count >= 0 and now - last['since'] >= idle
+
+    return check
+
+class BrowserPool:
+    '''
+    Keeps up to size headless Chrome browsers open and lends them out one page at a time
+    A browser that stops responding, or that has loaded max_pages pages, is closed and a new one is started when needed
+    '''
+    def __init__(self, size=pool_size, max_pages=pages_per_browser):
+        '''
+        Inputs:
+            size: the most browsers open at the same time
+            max_pages: the number of pages a browser loads before it is replaced
+        '''
+        self.size = size
+        self.max_pages = max_pages
+        self.idle = [] #browsers that are open and not being used
+        self.pages = {} #browser: the number of pages it has loaded
+        self.starting = 0 #the number of browsers being started, they count toward size
+        #waiting threads are woken whenever a browser is given back or closed, since either one frees a browser or a spot
+        self.ready = threading.Condition()
+
+    def new_browser(self):
+        '''
+        Starts a headless Chrome
+
+        Returns: a selenium web driver
+        '''
+        options = webdriver.ChromeOptions()
+        options.add_argument('--headless')
+        options.add_argument('--disable-gpu')
+        return webdriver.Chrome(chrome_path, options=options)
+
+    def acquire(self):
+        '''
+        Gets a browser, starting one if fewer than size are open, otherwise waiting for one to be given back or closed
+
+        Returns: a selenium web driver
+        '''
+        with self.ready:
+            while not self.idle and len(self.pages) + self.starting >= self.size:
+                self.ready.wait()
+            if self.idle:
+                browser = self.idle.pop()
+            else:
+                browser = None
+                self.starting += 1 #holds the spot while the browser starts
+
+        if browser is None:
+            try:
+                browser = self.new_browser()
+            except Exception:
+                with self.ready:
+                    self.starting -= 1
+                    self.ready.notify() #lets a waiting thread try to start one
+                raise
+            with self.ready:
+                self.starting -= 1
+                self.pages[browser] = 0
+            return browser
+
+        if not self.healthy(browser): #replaces browsers that crashed while they were waiting
+            self.retire(browser)
+            return self.acquire()
+        return browser
+
+    def release(self, browser, broken=False):
+        '''
+        Gives a browser back to the pool, closing it if it is broken or has loaded max_pages pages
+
+        Inputs:
+            browser: a selenium web driver from acquire
+            broken: True if something went wrong while the browser was being used
+        '''
+        with self.ready:
+            self.pages[browser] += 1
+            worn_out = self.pages[browser] >= self.max_pages
+            if not (broken or worn_out):
+                self.idle.append(browser)
+                self.ready.notify()
+        if broken or worn_out:
+            self.retire(browser)
+
+    def retire(self, browser):
+        '''
+        Closes a browser and frees its spot in the pool, waking a thread that is waiting for one
+
+        Inputs: browser: a selenium web driver
+        '''
+        with self.ready:
+            self.pages.pop(browser, None)
+            self.ready.notify()
+        try:
+            browser.quit() #quit closes Chrome and ChromeDriver, del only forgets about them
+        except WebDriverException:
+            pass
+
+    def healthy(self, browser):
+        '''
+        Checks that a browser still responds
+
+        Inputs: browser: a selenium web driver
+
+        Returns: True if the browser responds
+        '''
+        try:
+            browser.current_url
+            return True
+        except WebDriverException:
+            return False
+
+    @contextmanager
+    def browser(self):
+        '''
+        Lends out a browser for a with block and gives it back afterwards, even if something goes wrong
+        '''
+        browser = self.acquire()
+        try:
+            yield browser
+        except Exception:
+            self.release(browser, broken=True)
+            raise
+        self.release(browser)
+
+    def close(self):
+        '''
+        Closes every browser that is not being used
+        '''
+        with self.ready:
+            idle, self.idle = self.idle, []
+        for browser in idle:
+            self.retire(browser)
+
+def get_pool():
+    '''
+    Gets the shared BrowserPool, creating it the first time
+
+    Returns: a BrowserPool
+    '''
+    global browser_pool
+    if browser_pool is None:
+        browser_pool = BrowserPool()
+    return browser_pool
+
+def close_pool():
+    '''
+    Closes every browser in the shared BrowserPool
+    '''
+    global browser_pool
+    if browser_pool is not None:
+        browser_pool.close()
+        browser_pool = None
+
+def go_api(api=api_url, workers=api_workers):
+    '''
+    Gets the community numbers from the Health Atlas JSON data endpoints instead of loading every page in Chrome
+    Saves them to api_csv and api_long_csv in the same layout as go's CSVs, but not with the same columns:
+    there are only Year1 and Community columns (see map_payload), metrics are named after the topic names
+    (not the page row names), and communities are in the order the geographies endpoint lists them
+
+    Inputs:
+        api: the url the endpoints start with
+        workers: the number of endpoints to request at the same time
+    '''
+    topics = results(get_json(api + 'topics/')) #every metric the Health Atlas has
+    geo_names = community_names(get_json(api + 'geographies/', {'layer': api_layer}))
+
+    records = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        payloads = pool.map(lambda topic: get_json(api + 'data/', {'topic': topic['key'], 'layer': api_layer}), topics)
+        for topic, payload in zip(topics, payloads): #map gives the payloads back in the same order as topics
+            records.extend(map_payload(topic['name'], payload, geo_names))
+
+    long_df = pd.DataFrame.from_records(records, columns=long_cols)
+    order = {name: i for i, name in enumerate(geo_names.values())}
+    long_df = long_df.sort_values('community name', key=lambda names: names.map(order), kind='stable') #keeps the metrics in topic order within a community
+    long_df.to_csv(api_long_csv, index=False)
+    to_wide(long_df).to_csv(api_csv)
+
+    delete_lst([topics, geo_names, records, long_df])
+    gc.collect()
+
+def get_json(url, params=None):
+    '''
+    Gets a JSON endpoint, trying again after errors, and saves the response with page_cache
+
+    Inputs:
+        url: the url of the endpoint
+        params: a dictionary of query string parameters, if any
+
+    Returns: the decoded JSON
+    '''
+    if params:
+        url = url + '?' + urlencode(sorted(params.items())) #sorted so the same request is always saved under the same url
+
+    def download(url, headers):
+        for attempt in range(api_retries + 1):
+            if attempt > 0:
+                time.sleep(random.uniform(0, 2 ** attempt)) #waits longer after every error
+            try:
+                req = requests.get(url, headers=headers, timeout=30)
+            except (requests.ConnectionError, requests.Timeout):
+                continue
+            if req.status_code < 500:
+                return req if (req or req.status_code == 304) else None
+        return None
+
+    text = page_cache.get_text(url, download)
+    if text is None:
+        raise RuntimeError('Could not get ' + url)
+    return json.loads(text)
+
+def community_names(payload):
+    '''
+    Finds the name of every community area
+
+    Inputs: payload: the JSON from the geographies endpoint, a list of {"geoid": ..., "name": ...}
+        (or a dictionary with that list under "results")
+
+    Returns: a dictionary of geoid: community name
+    '''
+    return {str(geo['geoid']): geo['name'] for geo in results(payload)}
+
+def results(payload):
+    '''
+    Gets the list of items from an endpoint's JSON, which is either the list itself or a dictionary with the list under "results"
+
+    Inputs: payload: the decoded JSON
+
+    Returns: a list
+    '''
+    if isinstance(payload, dict):
+        return payload.get('results', [])
+    return payload
+
+def map_payload(metric, payload, geo_names):
+    '''
+    Turns the JSON from the data endpoint for one metric into long-format Community records, with the period as the year
+    The endpoint only gives the community's own number, so there are no Chicago records like the pages have
+
+    Inputs:
+        metric: the name of the metric
+        payload: the JSON from the data endpoint, a list of {"geoid": ..., "period": ..., "value": ...}
+            (or a dictionary with that list under "results")
+        geo_names: the dictionary from community_names
+
+    Returns: a list of (community name, metric, field, year, value) records
+    '''
+    records = []
+    for item in results(payload):
+        name = geo_names.get(str(item.get('geoid')))
+        if name is None: #not a community area
+            continue
+        period = None if item.get('period') is None else str(item['period'])
+        records.append((name, metric, 'Community', period, '' if item.get('value') is None else str(item['value'])))
+    return records
+
 def delete_lst(del_lst):
     '''
     deletes a list of objects
@@ -142,5 +603,20 @@ def delete_lst(del_lst):
     for item in del_lst:
         del item
 
-go()
-print('Complete')
+#The worker processes import this file too, so the scraper only starts when this file is run directly
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scrapes Chicago public health data')
+    parser.add_argument('--api', action='store_true', help='get the data from the JSON data endpoints instead of Chrome')
+    parser.add_argument('--api-url', default=api_url, help='the url the JSON data endpoints start with')
+    parser.add_argument('--workers', type=int, default=scrape_workers,
+        help='the number of worker processes, each with its own Chrome (default %d)' %scrape_workers)
+    args = parser.parse_args()
+
+    try:
+        if args.api:
+            go_api(args.api_url)
+        else:
+            go(workers=args.workers)
+    finally: #closes every Chrome we opened, even if the scraper stopped with an error
+        close_pool()
+    print('Complete')
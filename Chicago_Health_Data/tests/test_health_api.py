@@ -0,0 +1,127 @@
+'''
+Tests go_api against a local server that answers with the sample responses in tests/payloads
+The samples were written by hand in the shape go_api expects (they are not recorded from the Health Atlas)
+
+Run from Chicago_Health_Data with: python -m pytest tests
+'''
+import json
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import health_data_scraper as hds
+import page_cache
+
+payload_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payloads')
+
+class PayloadHandler(BaseHTTPRequestHandler):
+    '''
+    Answers each request with the sample response routes.json lists for it, or a 404
+    '''
+    def do_GET(self):
+        self.server.requested.append(self.path)
+        file_name = self.server.routes.get(self.path)
+        if file_name is None:
+            self.send_error(404)
+            return
+        with open(os.path.join(payload_dir, file_name), 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    '''
+    Starts the local server and gives back the url the endpoints start with
+    '''
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), PayloadHandler)
+    with open(os.path.join(payload_dir, 'routes.json')) as f:
+        httpd.routes = json.load(f)
+    httpd.requested = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd, 'http://127.0.0.1:{}/api/v1/'.format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+@pytest.fixture(autouse=True)
+def run_dir(tmp_path, monkeypatch):
+    '''
+    Runs each test in its own folder with its own empty page_cache
+    '''
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(page_cache, 'cache_dir', str(tmp_path / 'page_cache'))
+    monkeypatch.setattr(page_cache, 'index', None)
+    monkeypatch.setattr(page_cache, 'offline', False)
+    return tmp_path
+
+def test_go_api_writes_long_csv(server):
+    httpd, api = server
+    hds.go_api(api, workers=2)
+
+    long_df = pd.read_csv(hds.api_long_csv, dtype=str, keep_default_na=False)
+    assert list(long_df.columns) == hds.long_cols
+    assert long_df.values.tolist() == [
+        ['Albany Park', 'Obesity', 'Community', '2016-2018', '31.9'],
+        ['Albany Park', 'Population', 'Community', '', '51542'],
+        ['Rogers Park', 'Obesity', 'Community', '2016-2018', '27.4'],
+        ['Rogers Park', 'Population', 'Community', '2014-2018', '55062'],
+        ['Edgewater', 'Obesity', 'Community', '2016-2018', ''],
+        ['Edgewater', 'Population', 'Community', '2014-2018', '56296'],
+    ]
+
+def test_go_api_writes_wide_csv(server):
+    httpd, api = server
+    hds.go_api(api, workers=2)
+
+    wide = pd.read_csv(hds.api_csv, index_col=0, dtype=str, keep_default_na=False)
+    assert list(wide.columns) == ['community name', 'Year1 Obesity', 'Community Obesity',
+        'Community Population', 'Year1 Population'] #columns are in the order they were first seen
+    assert list(wide['community name']) == ['Albany Park', 'Rogers Park', 'Edgewater']
+    assert wide['Year1 Population'].iloc[0] == 'Not Listed' #Albany Park has no period for Population
+    assert wide['Community Obesity'].iloc[1] == '27.4'
+    assert not os.path.exists('chicago_health_data.csv') #the CSV from Chrome is not written over
+
+def test_go_api_requests_every_endpoint_once(server):
+    httpd, api = server
+    hds.go_api(api, workers=2)
+    assert sorted(httpd.requested) == sorted(httpd.routes)
+
+    hds.go_api(api, workers=2) #the second run only uses the responses page_cache saved
+    assert len(httpd.requested) == len(httpd.routes)
+
+def test_go_api_missing_endpoint(server, monkeypatch):
+    httpd, api = server
+    monkeypatch.setattr(hds, 'api_layer', 'tract') #the server has no sample responses for tracts
+    with pytest.raises(RuntimeError):
+        hds.go_api(api, workers=2)
+
+def test_results_accepts_both_shapes():
+    items = [{'key': 'POP', 'name': 'Population'}]
+    assert hds.results(items) == items
+    assert hds.results({'results': items}) == items
+
+def test_map_payload_skips_other_geographies():
+    geo_names = {'1': 'Rogers Park'}
+    payload = [{'geoid': 1, 'period': 2018, 'value': 5}, {'geoid': '17031', 'period': 2018, 'value': 6}]
+    assert hds.map_payload('Obesity', payload, geo_names) == [('Rogers Park', 'Obesity', 'Community', '2018', '5')]
+
+def test_to_wide_puts_each_year_before_its_number():
+    long_df = pd.DataFrame.from_records([
+        ('Albany Park', 'Obesity', 'Community', '2018', '31'), ('Albany Park', 'Obesity', 'Chicago', '2017', '30'),
+        ('Rogers Park', 'Obesity', 'Community', '2018', '27')], columns=hds.long_cols)
+    wide = hds.to_wide(long_df)
+    assert list(wide.columns) == ['community name', 'Year1 Obesity', 'Community Obesity', 'Year2 Obesity', 'Chicago Obesity']
+    assert wide.values.tolist() == [['Albany Park', '2018', '31', '2017', '30'],
+        ['Rogers Park', '2018', '27', 'Not Listed', 'Not Listed']]
@@ -6,20 +6,721 @@ https://data.cityofchicago.org/Public-Safety/Crimes-2001-to-present-Dashboard/5c
 '''
 
 import pandas as pd
+import numpy as np
+import shapely
+import pyarrow as pa
+import pyarrow.dataset as ds
+import shutil
+import json
+import os
+import csv
+import io
+import mmap
 import gc
 
-df = pd.read_csv('Crimes_-_2001_to_present.csv') #turns downloaded data into a pandas dataframe
-
-for year in [2019, 2018, 2017, 2016]: #You can change this to include only the year(s) you want information for
-    filt = df['Year'] == year #filters out only the year you want
-    df_yr = df[filt]
-    name = ('CPD_%s.csv' %str(year)) #creates a name specific to the year you are getting information for
-    df_yr.to_csv(name) #turns the filtered dataframe into a CSV
-
-#The following commands clean up the objects you created
-del df
-del filt
-del name
-del year
-del df_yr
-gc.collect
+crimes_csv = 'Crimes_-_2001_to_present.csv' #the name of the downloaded data
+years_lst = [2019, 2018, 2017, 2016] #You can change this to include only the year(s) you want information for
+chunk_rows = 500000 #the number of rows read into memory at one time, lower this if you run out of memory
+parquet_dir = 'CPD_parquet' #the folder the Parquet dataset is saved to
+row_group_rows = 10000 #the rows in each part of a Parquet file, smaller parts let filters skip more but make files bigger
+tracts_csv = 'CensusTractsTIGER2010.csv' #the census tract shapes, the same file census_data/census_api.py uses
+cube_parquet = 'CPD_cube.parquet' #crime counts by cube_dims, kept up to date by update
+year_index_json = 'CPD_year_index.json' #where each year's rows are in the downloaded CSV
+watermark_json = 'CPD_watermark.json' #remembers the newest ID and Updated On we have saved
+date_format = '%m/%d/%Y %I:%M:%S %p' #the format of the Date column, e.g. 01/31/2019 11:45:00 PM
+
+#This makes sure every chunk has the same column types when we save to Parquet
+#Codes that look like numbers but are not (e.g. the IUCR code 0486) are read as text
+#Numbers that can be missing are read as floats, even in chunks where none are missing
+col_types = {'Case Number': str, 'Block': str, 'IUCR': str, 'Primary Type': str, 'Description': str,
+    'Location Description': str, 'FBI Code': str, 'Updated On': str, 'Location': str, 'District': float,
+    'Ward': float, 'Community Area': float, 'X Coordinate': float, 'Y Coordinate': float,
+    'Latitude': float, 'Longitude': float}
+
+#This is the smallest set of types that fits the data, used by load_crimes to keep the data small in memory
+#Columns with only a few different values are categories, IDs and codes are the smallest ints they fit in
+#District, Ward, and Community Area can be missing, so they use the nullable ints (with a capital I)
+crime_schema = {'ID': 'int32', 'Case Number': str, 'Block': 'category', 'IUCR': 'category', 'Primary Type': 'category',
+    'Description': 'category', 'Location Description': 'category', 'Arrest': bool, 'Domestic': bool, 'Beat': 'int16',
+    'District': 'Int8', 'Ward': 'Int8', 'Community Area': 'Int8', 'FBI Code': 'category', 'X Coordinate': 'float32',
+    'Y Coordinate': 'float32', 'Year': 'int16', 'Updated On': str, 'Latitude': 'float64', 'Longitude': 'float64',
+    'Location': str}
+date_cols = ['Date', 'Updated On'] #these are turned into dates using date_format
+cube_dims = ['TRACTCE10', 'Community Area', 'Year', 'Month', 'Primary Type', 'Arrest'] #what the crime counts in the cube are grouped by
+cube_cols = ['Date', 'Year', 'Primary Type', 'Arrest', 'Community Area', 'Latitude', 'Longitude'] #the columns needed to build the cube
+coord_cols = ['Latitude', 'Longitude', 'X Coordinate', 'Y Coordinate'] #the columns that give a crime's location
+
+def go(csv_name=crimes_csv, years=years_lst, chunk_size=chunk_rows, output='csv'):
+    '''
+    Pulls the years you want out of the downloaded data and saves them
+
+    Inputs:
+        csv_name: the name of the downloaded CSV
+        years: a list of the years you want information for
+        chunk_size: the number of rows to read at one time, if None the whole file is read at once
+        output: 'csv' to save each year to its own CSV, 'parquet' to save a Parquet dataset split by year and month
+    '''
+    if output == 'parquet':
+        write_parquet(csv_name, years, chunk_size or chunk_rows)
+    elif chunk_size is None:
+        split_years(csv_name, years)
+    else:
+        stream_years(csv_name, years, chunk_size)
+    gc.collect()
+
+def year_csv_name(year):
+    '''
+    Creates a name specific to the year you are getting information for
+
+    Inputs: year: the year as an int or a string
+
+    Returns: the name of the CSV for that year
+    '''
+    return 'CPD_%s.csv' %str(year)
+
+def split_years(csv_name, years):
+    '''
+    Reads the whole downloaded CSV at once and saves each year to its own CSV
+    This needs enough memory to hold the whole file
+
+    Inputs:
+        csv_name: the name of the downloaded CSV
+        years: a list of the years you want information for
+    '''
+    df = pd.read_csv(csv_name, dtype=col_types) #turns downloaded data into a pandas dataframe
+
+    for year in years:
+        filt = df['Year'] == year #filters out only the year you want
+        df_yr = df[filt]
+        df_yr.to_csv(year_csv_name(year)) #turns the filtered dataframe into a CSV
+
+    del df
+
+def stream_years(csv_name, years, chunk_size):
+    '''
+    Reads the downloaded CSV once, chunk_size rows at a time, and appends the rows of each
+    chunk to the CSV for their year. Only one chunk is held in memory at a time
+
+    Inputs:
+        csv_name: the name of the downloaded CSV
+        years: a list of the years you want information for
+        chunk_size: the number of rows to read at one time
+
+    Returns: the number of rows written
+    '''
+    started = set() #the years whose CSV we have already started writing to
+    rows = 0
+
+    #col_types keeps every chunk writing the same formats (e.g. District as 1.0, not 1 in one chunk and 1.0 in another)
+    for chunk in pd.read_csv(csv_name, chunksize=chunk_size, dtype=col_types):
+        chunk = chunk[chunk['Year'].isin(years)] #we only want the rows from the years we asked for
+        rows += len(chunk)
+        for year, df_yr in chunk.groupby('Year'):
+            if year in started: #adds to the end of the CSV we already started
+                df_yr.to_csv(year_csv_name(year), mode='a', header=False)
+            else: #writes over any CSV left over from an earlier run
+                df_yr.to_csv(year_csv_name(year))
+                started.add(year)
+        del chunk
+
+    for year in years: #years with no rows still get a CSV with just the column names
+        if year not in started:
+            pd.read_csv(csv_name, nrows=0).to_csv(year_csv_name(year))
+    return rows
+
+def load_crimes(csv_name=crimes_csv, years=None, chunk_size=chunk_rows, report=False):
+    '''
+    Loads crimes into a dataframe using crime_schema instead of letting pandas guess the types
+    The file is read chunk_size rows at a time so only the rows you keep are held in memory
+
+    Inputs:
+        csv_name: the name of the downloaded CSV (or one of the year CSVs)
+        years: a list of the years you want, if None all years are kept
+        chunk_size: the number of rows to read at one time
+        report: if True, prints how much memory each column takes with and without crime_schema
+
+    Returns: a pandas dataframe
+    '''
+    df_lst = []
+    for chunk in pd.read_csv(csv_name, chunksize=chunk_size, dtype=crime_schema,
+            true_values=['true', 'True'], false_values=['false', 'False']):
+        if years is not None:
+            chunk = chunk[chunk['Year'].isin(years)]
+        for col in date_cols: #we parse the dates once here so no one has to later
+            chunk[col] = pd.to_datetime(chunk[col], format=date_format)
+        df_lst.append(chunk)
+        del chunk
+    df = concat_chunks(df_lst)
+    del df_lst
+
+    if report:
+        print(memory_report(csv_name, df, years, chunk_size))
+    return df
+
+def concat_chunks(df_lst):
+    '''
+    Puts chunks of crimes together without losing their category columns
+    (pandas turns a category column back into text if the chunks have different categories)
+
+    Inputs: df_lst: a list of pandas dataframes with the same columns
+
+    Returns: a pandas dataframe
+    '''
+    if len(df_lst) == 0:
+        return pd.DataFrame(columns=list(crime_schema) + ['Date'])
+    for col in df_lst[0].select_dtypes('category').columns:
+        categories = pd.api.types.union_categoricals([df[col] for df in df_lst]).categories
+        for df in df_lst:
+            df[col] = df[col].cat.set_categories(categories)
+    return pd.concat(df_lst)
+
+def memory_report(csv_name, df, years=None, chunk_size=chunk_rows):
+    '''
+    Compares the memory each column takes when pandas guesses the types to the memory it takes in df
+    The guessed types are measured one chunk at a time, so this does not need to load the whole file twice
+
+    Inputs:
+        csv_name: the name of the CSV df was loaded from
+        df: the dataframe loaded with crime_schema
+        years: the years df was filtered to
+        chunk_size: the number of rows to read at one time
+
+    Returns: a pandas dataframe with the bytes before and after for each column
+    '''
+    before = None
+    for chunk in pd.read_csv(csv_name, chunksize=chunk_size):
+        if years is not None:
+            chunk = chunk[chunk['Year'].isin(years)]
+        usage = chunk.memory_usage(index=False, deep=True)
+        before = usage if before is None else before + usage
+        del chunk
+
+    report = pd.DataFrame({'before': before, 'after': df.memory_usage(index=False, deep=True)})
+    report.loc['Total'] = report.sum()
+    report['% saved'] = (100 * (1 - report['after'] / report['before'])).round(1)
+    return report
+
+def backfill_year(year, prior_years, chunk_size=chunk_rows):
+    '''
+    Fills in missing locations in a year's CSV using the locations of the same block in earlier years
+    and saves the result to CPD_<year>_filled.csv
+
+    Inputs:
+        year: the year you want to fill in
+        prior_years: a list of earlier years to take locations from, their year CSVs must already exist
+        chunk_size: the number of rows to read at one time
+
+    Returns: the filled in pandas dataframe
+    '''
+    df = load_crimes(year_csv_name(year), chunk_size=chunk_size)
+    prior_lst = [pd.read_csv(year_csv_name(y), usecols=['Block', 'Beat'] + coord_cols) for y in prior_years]
+    beat_index, block_index = build_coord_index(prior_lst)
+    del prior_lst
+
+    df = backfill_coordinates(df, beat_index, block_index)
+    df.to_csv('CPD_%s_filled.csv' %str(year))
+    return df
+
+def build_coord_index(df_lst):
+    '''
+    Builds lookup tables of where each block is from crimes that have a location
+    Each block's location is the median of the locations of all the crimes on that block
+
+    Inputs: df_lst: a list of pandas dataframes with Block, Beat, and the coord_cols
+
+    Returns:
+        beat_index: locations looked up by Block and Beat
+        block_index: locations looked up by Block only, for blocks whose beat was not seen before
+    '''
+    known = pd.concat([df[['Block', 'Beat'] + coord_cols].dropna() for df in df_lst])
+    known['Block'] = known['Block'].astype(str)
+    known['Beat'] = known['Beat'].astype('int64')
+    beat_index = known.groupby(['Block', 'Beat'])[coord_cols].median()
+    block_index = known.groupby('Block')[coord_cols].median()
+    del known
+    return beat_index, block_index
+
+def backfill_coordinates(df, beat_index, block_index):
+    '''
+    Fills in crimes that are missing a location, first by Block and Beat and then by Block only
+    Adds a 'Coordinates Filled' column that says how each row got its location:
+        'Original': the location was already there
+        'Block and Beat': filled in from the same block and beat
+        'Block': filled in from the same block
+        'Not Filled': the block has never had a location
+
+    Inputs:
+        df: a pandas dataframe of crimes, its index must not have repeats
+        beat_index, block_index: the lookup tables from build_coord_index
+
+    Returns: the filled in pandas dataframe
+    '''
+    missing = df['Latitude'].isna() | df['Longitude'].isna()
+    filled = pd.Series('Original', index=df.index)
+    filled[missing] = 'Not Filled'
+
+    #we only look up the rows that are missing a location
+    keys = df.loc[missing, ['Block', 'Beat']].dropna()
+    keys = keys.astype({'Block': str, 'Beat': 'int64'})
+    for index, on, label in [(beat_index, ['Block', 'Beat'], 'Block and Beat'), (block_index, 'Block', 'Block')]:
+        found = keys.join(index, on=on).dropna(subset=['Latitude', 'Longitude'])
+        df.loc[found.index, coord_cols] = found[coord_cols].astype(df[coord_cols].dtypes.to_dict())
+        filled[found.index] = label
+        keys = keys.drop(found.index) #rows we filled in do not need to be looked up again
+
+    df['Coordinates Filled'] = filled.astype('category')
+    return df
+
+def load_tracts(tracts_name=tracts_csv):
+    '''
+    Loads the census tract shapes and puts them in a tree so we can quickly find which tract a point is in
+
+    Inputs: tracts_name: the name of the census tracts CSV, its the_geom column holds each tract's shape
+
+    Returns:
+        tree: a shapely STRtree of the tract shapes
+        tract_ids: the TRACTCE10 of each shape, in the same order as the tree
+    '''
+    tracts_df = pd.read_csv(tracts_name, usecols=['the_geom', 'TRACTCE10'])
+    tree = shapely.STRtree(shapely.from_wkt(tracts_df['the_geom'].values))
+    tract_ids = tracts_df['TRACTCE10'].values
+    del tracts_df
+    return tree, tract_ids
+
+def add_tracts(df, tracts=None, batch_size=100000):
+    '''
+    Adds a TRACTCE10 column with the census tract each crime happened in
+    Crimes are looked up batch_size at a time, each batch with one call to the tree
+    Crimes without a location or outside every tract get a missing value
+
+    Inputs:
+        df: a pandas dataframe of crimes with Latitude and Longitude
+        tracts: the (tree, tract_ids) from load_tracts, if None they are loaded from tracts_csv
+        batch_size: the number of crimes to look up at one time
+
+    Returns: the pandas dataframe with a TRACTCE10 column
+    '''
+    tree, tract_ids = tracts if tracts is not None else load_tracts()
+    tract = np.full(len(df), -1, dtype='int64') #-1 means we did not find a tract
+    lon = df['Longitude'].to_numpy(dtype='float64', na_value=np.nan)
+    lat = df['Latitude'].to_numpy(dtype='float64', na_value=np.nan)
+
+    for start in range(0, len(df), batch_size):
+        points = shapely.points(lon[start:start + batch_size], lat[start:start + batch_size]) #missing locations never match a tract
+        #covered_by (unlike within) also matches points on a tract's edge, so a point on the border of two tracts
+        #is matched to both and we keep the first one
+        point_idx, tract_idx = tree.query(points, predicate='covered_by')
+        point_idx, first = np.unique(point_idx, return_index=True)
+        tract[start + point_idx] = tract_ids[tract_idx[first]]
+        del points
+
+    df['TRACTCE10'] = pd.array(np.where(tract < 0, None, tract), dtype='Int32')
+    return df
+
+def add_month(df):
+    '''
+    Adds a Month column to a dataframe of crimes using the Date column
+
+    Inputs: df: a pandas dataframe of crimes
+
+    Returns: the dataframe with a Month column
+    '''
+    df['Month'] = pd.to_datetime(df['Date'], format=date_format).dt.month
+    return df
+
+def write_parquet(csv_name, years, chunk_size, root=parquet_dir):
+    '''
+    Saves the years you want as a Parquet dataset with a folder for every year and month
+    (e.g. CPD_parquet/Year=2019/Month=1). Inside a folder, rows are sorted by Primary Type and District
+    and saved in parts (row groups) of row_group_rows rows. Each part remembers its smallest and largest
+    Primary Type and District, so a filter on those columns skips the parts that cannot match
+    (District filters skip the most when combined with a Primary Type filter, since District is sorted second)
+
+    Inputs:
+        csv_name: the name of the downloaded CSV
+        years: a list of the years you want information for
+        chunk_size: the number of rows to read at one time
+        root: the folder to save the dataset to, anything already in it is deleted
+    '''
+    shutil.rmtree(root, ignore_errors=True) #we do not want files left over from an earlier run
+
+    for index, chunk in enumerate(pd.read_csv(csv_name, chunksize=chunk_size, dtype=col_types)):
+        chunk = chunk[chunk['Year'].isin(years)]
+        if len(chunk) == 0:
+            continue
+        chunk = add_month(chunk).sort_values(['Year', 'Month', 'Primary Type', 'District'])
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        #every chunk gets its own file names so it does not write over the chunks before it
+        ds.write_dataset(table, root, format='parquet', partitioning=['Year', 'Month'], partitioning_flavor='hive',
+            basename_template='chunk' + str(index) + '-{i}.parquet', existing_data_behavior='overwrite_or_ignore',
+            preserve_order=True, min_rows_per_group=row_group_rows, max_rows_per_group=row_group_rows)
+        del chunk, table
+
+def read_parquet(root=parquet_dir, columns=None, years=None, months=None, districts=None, primary_types=None):
+    '''
+    Reads crimes from the Parquet dataset made by write_parquet
+    Only the folders for the years and months you ask for are opened, and only the columns you ask for are read.
+    Filters on district and primary type are checked against each part (row group) of a file before it is read
+
+    Example: 2018 battery counts by district
+        read_parquet(columns=['District'], years=[2018], primary_types=['BATTERY'])['District'].value_counts()
+
+    Inputs:
+        root: the folder the dataset was saved to
+        columns: a list of the columns you want, if None all columns are read
+        years, months, districts, primary_types: lists of the values you want to keep, if None no rows are filtered out
+
+    Returns: a pandas dataframe
+    '''
+    dataset = ds.dataset(root, format='parquet', partitioning='hive')
+    filt = None
+    for col, values in [('Year', years), ('Month', months), ('District', districts), ('Primary Type', primary_types)]:
+        if values is not None:
+            expr = ds.field(col).isin(values)
+            filt = expr if filt is None else filt & expr #only keeps rows that pass every filter
+
+    return dataset.to_table(columns=columns, filter=filt).to_pandas()
+
+def update(csv_name=crimes_csv, years=years_lst, chunk_size=chunk_rows, watermark_name=watermark_json, cube_name=cube_parquet):
+    '''
+    Adds new and changed records to the CSVs for each year without rebuilding them
+    A record is new or changed if its ID is higher than any we have saved or its Updated On is at or after
+    the newest Updated On we have saved. Only the year CSVs with new or changed records are rewritten and
+    records that are already in them are replaced (matched by ID)
+    The cube of crime counts is updated with only the new and changed records
+    If there is no watermark yet, every year CSV and the cube are built from scratch first
+
+    Limitation: every row of csv_name is still parsed to find the new and changed records, so with the full export
+    (every year since 2001) a nightly update reads the whole file even if only a few records changed.
+    Pass a smaller export with only the recently updated records (filtered on Updated On) as csv_name to avoid this
+
+    Note: a record whose Year changes stays in its old year's CSV until that CSV is built from scratch
+
+    Inputs:
+        csv_name: the name of the downloaded CSV
+        years: a list of the years you want information for
+        chunk_size: the number of rows to read at one time
+        watermark_name: the name of the file that remembers what we have already saved
+        cube_name: the name of the cube file
+
+    Returns: the number of new or changed records (on the first run, the number of records written)
+    '''
+    watermark = read_watermark(watermark_name)
+    if watermark is None:
+        rows = stream_years(csv_name, years, chunk_size)
+        build_cube([csv_name], years, chunk_size, cube_name)
+        write_watermark(find_watermark(csv_name, chunk_size), watermark_name)
+        return rows
+
+    last_updated = pd.to_datetime(watermark['Updated On'], format=date_format)
+    delta_lst = []
+    for chunk in pd.read_csv(csv_name, chunksize=chunk_size, dtype=col_types):
+        updated = pd.to_datetime(chunk['Updated On'], format=date_format)
+        filt = ((updated >= last_updated) | (chunk['ID'] > watermark['ID'])) & chunk['Year'].isin(years)
+        delta_lst.append(chunk[filt])
+        del chunk
+    delta = pd.concat(delta_lst)
+    del delta_lst
+
+    removed_lst = [] #the old versions of records that changed, their counts come out of the cube
+    for year, df_yr in delta.groupby('Year'):
+        name = year_csv_name(year)
+        if os.path.exists(name):
+            old = pd.read_csv(name, index_col=0, dtype=col_types)
+            changed = old['ID'].isin(df_yr['ID'])
+            removed_lst.append(old.loc[changed, cube_cols])
+            old = old[~changed] #takes out the old version of records that changed
+            df_yr = pd.concat([old, df_yr])
+            del old
+        df_yr.to_csv(name)
+
+    if len(delta) > 0:
+        if os.path.exists(cube_name):
+            update_cube(delta[cube_cols], removed_lst, cube_name)
+        else: #the year CSVs are already up to date, so the cube can be built from them
+            build_cube([year_csv_name(year) for year in years if os.path.exists(year_csv_name(year))], years, chunk_size, cube_name)
+        write_watermark(newest(delta, watermark), watermark_name)
+    return len(delta)
+
+def cube_counts(df, tracts):
+    '''
+    Counts crimes by cube_dims
+
+    Inputs:
+        df: a pandas dataframe of crimes with the cube_cols
+        tracts: the (tree, tract_ids) from load_tracts
+
+    Returns: a pandas dataframe with the cube_dims and a Count column
+    '''
+    df = add_month(add_tracts(df[cube_cols].copy(), tracts))
+    return df.groupby(cube_dims, dropna=False, observed=True).size().rename('Count').reset_index()
+
+def add_counts(cube_lst):
+    '''
+    Adds up crime counts that share the same cube_dims, counts that add up to 0 are dropped
+
+    Inputs: cube_lst: a list of pandas dataframes with the cube_dims and a Count column
+
+    Returns: a pandas dataframe with the cube_dims and a Count column
+    '''
+    cube = pd.concat(cube_lst).groupby(cube_dims, dropna=False, observed=True)['Count'].sum().reset_index()
+    cube = cube[cube['Count'] != 0]
+    return cube.astype({'Count': 'int64'}).reset_index(drop=True)
+
+def build_cube(csv_names, years, chunk_size, cube_name=cube_parquet):
+    '''
+    Builds the cube of crime counts from scratch, reading the CSVs chunk_size rows at a time
+
+    Inputs:
+        csv_names: a list of CSVs of crimes (the downloaded CSV or the year CSVs)
+        years: a list of the years you want counts for
+        chunk_size: the number of rows to read at one time
+        cube_name: the name of the file to save the cube to
+
+    Returns: the cube as a pandas dataframe
+    '''
+    tracts = load_tracts()
+    cube_lst = []
+    for csv_name in csv_names:
+        for chunk in pd.read_csv(csv_name, chunksize=chunk_size, usecols=cube_cols, dtype=col_types):
+            chunk = chunk[chunk['Year'].isin(years)]
+            cube_lst.append(cube_counts(chunk, tracts))
+            del chunk
+        cube_lst = [add_counts(cube_lst)] #keeps the list short so memory does not grow with the number of chunks
+
+    cube = add_counts(cube_lst)
+    cube.to_parquet(cube_name, index=False)
+    return cube
+
+def update_cube(added, removed_lst, cube_name=cube_parquet):
+    '''
+    Updates the saved cube without going back to the raw records:
+    new records are added to the counts and the old versions of changed records are taken out
+
+    Inputs:
+        added: a pandas dataframe of the new and changed records
+        removed_lst: a list of pandas dataframes with the old versions of the changed records
+        cube_name: the name of the cube file
+
+    Returns: the updated cube as a pandas dataframe
+    '''
+    tracts = load_tracts()
+    cube_lst = [pd.read_parquet(cube_name), cube_counts(added, tracts)]
+    for removed in removed_lst:
+        removed_counts = cube_counts(removed, tracts)
+        removed_counts['Count'] = -removed_counts['Count']
+        cube_lst.append(removed_counts)
+
+    cube = add_counts(cube_lst)
+    cube.to_parquet(cube_name, index=False)
+    return cube
+
+def query_cube(by, cube=None, years=None, months=None, primary_types=None, arrest=None):
+    '''
+    Answers "how many crimes by ..." questions from the cube instead of the raw records
+    Load the cube once with pd.read_parquet(cube_parquet) and pass it in if you are asking many questions
+
+    Example: 2018 battery counts by community area
+        query_cube(['Community Area'], years=[2018], primary_types=['BATTERY'])
+
+    Inputs:
+        by: a list of cube_dims to group the counts by
+        cube: the cube as a pandas dataframe, if None it is read from cube_parquet
+        years, months, primary_types: lists of the values you want to keep, if None no rows are filtered out
+        arrest: True or False to only count crimes with or without an arrest, if None both are counted
+
+    Returns: a pandas dataframe with the columns in by and a Count column
+    '''
+    if cube is None:
+        cube = pd.read_parquet(cube_parquet)
+    filt = pd.Series(True, index=cube.index)
+    for col, values in [('Year', years), ('Month', months), ('Primary Type', primary_types)]:
+        if values is not None:
+            filt &= cube[col].isin(values)
+    if arrest is not None:
+        filt &= cube['Arrest'] == arrest
+
+    return cube[filt].groupby(by, dropna=False)['Count'].sum().reset_index()
+
+def rolling_cube(by, window, cube=None, **filters):
+    '''
+    Gives rolling crime counts over the last window months for each group
+
+    Example: 3 month rolling counts of narcotics crimes by tract
+        rolling_cube(['TRACTCE10'], 3, primary_types=['NARCOTICS'])
+
+    Inputs:
+        by: a list of cube_dims to group the counts by (not Year or Month)
+        window: the number of months to add up
+        cube: the cube as a pandas dataframe, if None it is read from cube_parquet
+        filters: the same filters query_cube takes
+
+    Returns: a pandas dataframe with a row for every group and month and a Rolling Count column
+    '''
+    counts = query_cube(by + ['Year', 'Month'], cube, **filters)
+    counts['Period'] = pd.PeriodIndex.from_fields(year=counts['Year'], month=counts['Month'], freq='M')
+    #months with no crimes still count towards the window, so we fill them in with 0
+    wide = counts.pivot_table(index='Period', columns=by, values='Count', aggfunc='sum', fill_value=0)
+    wide = wide.reindex(pd.period_range(wide.index.min(), wide.index.max(), freq='M'), fill_value=0)
+    rolling = wide.rolling(window, min_periods=1).sum().astype('int64')
+    rolling.index.name = 'Period'
+    return rolling.stack(list(range(len(by)))).rename('Rolling Count').reset_index()
+
+def build_year_index(csv_name=crimes_csv, index_name=year_index_json):
+    '''
+    Reads the downloaded CSV once and saves the byte ranges where each year's rows are
+    The file is mostly in order, so each year is only in a few ranges
+    Rows are found with csv_rows, so a quoted field with a line break in it does not split its row
+    The size and modified time of the CSV are saved too, so we know when the index is out of date
+
+    Inputs:
+        csv_name: the name of the downloaded CSV
+        index_name: the name of the file to save the index to
+
+    Returns: the index as a dictionary
+    '''
+    ranges = {} #year: a list of [start, end] byte ranges
+    with open(csv_name, 'rb') as f:
+        rows = csv_rows(f)
+        header_end, header = next(rows)
+        year_col = header.index('Year')
+        start = header_end
+        cur_year = None
+        for end, row in rows:
+            year = row[year_col]
+            if year != cur_year: #a new range starts whenever the year changes
+                ranges.setdefault(year, []).append([start, start])
+                cur_year = year
+            ranges[year][-1][1] = end
+            start = end
+
+    stat = os.stat(csv_name)
+    index = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'header_end': header_end, 'ranges': ranges}
+    with open(index_name, 'w') as f:
+        json.dump(index, f)
+    return index
+
+def csv_rows(f):
+    '''
+    Reads the rows of a CSV opened in binary mode and keeps track of where each one ends in the file
+    A line break inside a quoted field does not end a row: a row only ends once it has an even number of quotes
+    (quotes inside a quoted field are written twice, so they keep the count even)
+
+    Inputs: f: a file opened with open(name, 'rb')
+
+    Returns: a generator of (the byte position just after the row, the row as a list of strings)
+    '''
+    pos = f.tell()
+    record = b''
+    for line in iter(f.readline, b''):
+        pos += len(line)
+        record += line
+        if record.count(b'"') % 2 == 0:
+            yield pos, next(csv.reader([record.decode()]))
+            record = b''
+    if record: #the last row has an unmatched quote
+        yield pos, next(csv.reader([record.decode()]))
+
+def load_year_index(csv_name=crimes_csv, index_name=year_index_json):
+    '''
+    Loads the year index, building it again if it is missing or the CSV has changed since it was built
+
+    Inputs:
+        csv_name: the name of the downloaded CSV
+        index_name: the name of the index file
+
+    Returns: the index as a dictionary
+    '''
+    if os.path.exists(index_name):
+        with open(index_name) as f:
+            index = json.load(f)
+        stat = os.stat(csv_name)
+        if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime_ns and 'header_end' in index:
+            return index
+    return build_year_index(csv_name, index_name)
+
+def read_year(year, csv_name=crimes_csv, index_name=year_index_json, dtype=col_types):
+    '''
+    Reads one year of crimes, only parsing the parts of the CSV the year index says hold that year
+
+    Inputs:
+        year: the year you want
+        csv_name: the name of the downloaded CSV
+        index_name: the name of the index file
+        dtype: the column types to read with
+
+    Returns: a pandas dataframe
+    '''
+    index = load_year_index(csv_name, index_name)
+    ranges = index['ranges'].get(str(year), [])
+    header_end = index['header_end']
+    with open(csv_name, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = io.BytesIO()
+        buf.write(mm[:header_end]) #the column names
+        for start, end in ranges:
+            buf.write(mm[start:end])
+        mm.close()
+
+    buf.seek(0)
+    return pd.read_csv(buf, dtype=dtype)
+
+def newest(df, watermark=None):
+    '''
+    Finds the highest ID and the newest Updated On in a dataframe of crimes
+
+    Inputs:
+        df: a pandas dataframe of crimes
+        watermark: an earlier watermark to compare against, if there is one
+
+    Returns: a watermark dictionary with the keys 'ID' and 'Updated On'
+    '''
+    updated = pd.to_datetime(df['Updated On'], format=date_format).max()
+    last_id = int(df['ID'].max())
+    if watermark is not None:
+        updated = max(updated, pd.to_datetime(watermark['Updated On'], format=date_format))
+        last_id = max(last_id, watermark['ID'])
+    return {'ID': last_id, 'Updated On': updated.strftime(date_format)}
+
+def find_watermark(csv_name, chunk_size):
+    '''
+    Finds the watermark of a whole CSV, only reading the ID and Updated On columns
+
+    Inputs:
+        csv_name: the name of the downloaded CSV
+        chunk_size: the number of rows to read at one time
+
+    Returns: a watermark dictionary with the keys 'ID' and 'Updated On'
+    '''
+    watermark = None
+    for chunk in pd.read_csv(csv_name, chunksize=chunk_size, usecols=['ID', 'Updated On']):
+        watermark = newest(chunk, watermark)
+    return watermark
+
+def read_watermark(watermark_name):
+    '''
+    Reads the watermark saved by an earlier run
+
+    Inputs: watermark_name: the name of the watermark file
+
+    Returns: a watermark dictionary or None if there is no watermark file
+    '''
+    if not os.path.exists(watermark_name):
+        return None
+    with open(watermark_name) as f:
+        return json.load(f)
+
+def write_watermark(watermark, watermark_name):
+    '''
+    Saves the watermark so the next run knows what we have already saved
+
+    Inputs:
+        watermark: a watermark dictionary
+        watermark_name: the name of the watermark file
+    '''
+    with open(watermark_name, 'w') as f:
+        json.dump(watermark, f)
+
+if __name__ == '__main__':
+    go()
+    print('Complete')
@@ -6,110 +6,60 @@ Scrapes data about all schools from the CPS website
 This web scraper was created in the summer of 2019 and may need to be updated if CPS changes their website
 '''
 #Downloads needed for this section of the code
-import pandas as pd
+import argparse
+import csv
+import json
+import os
 import gc
 import scraping_helper_functions as shf
 from cps_individual_school_data_2019 import scrape_page
 
-#Initializes the dictionary we will use to store data
-data = {'School ID': [],
-        'OfficialSchoolName': [],
-        'School Prefix': [],
-        'Address': [],
-        'lPhone': [], 
-        'lFax': [],
-        'Website': [],
-        'OverallRating': [],
-        'RatingStatus': [],
-        'SchoolGradeText': [],
-        'NumberOfStudents': [],
-        'SchoolType': [],
-        'SchoolAdministrator': [],
-        'SchoolAdministratorTitle': [],
-        'SecondaryContact': [],
-        'SecondaryContactTitle': [],
-        'Hours': [],
-        'EarliestDropOffTime': [],
-        'AfterSchoolHours': [],
-        'Transit': [],
-        'Kindergarten': [],
-        'BilingualServices': [],
-        'ClassroomLanguages': [],
-        'Uniform': [],
-        'AttendanceBoundaries': [],
-        'RefugeeServices': [],
-        'Title1Eligible': [],
-        'Asian': [],
-        'Black': [],
-        'Hispanic': [],
-        'White': [],
-        'Other': [],
-        'Low Income': [], 
-        'Diverse Learners': [], 
-        'Limited English': [], 
-        'Mobility Rate': [], 
-        'Chronic Truancy': [],
-        'lStudentGrowth': [],
-        'lStudentAttainment': [],
-        'lCultureClimate': [],
-        'NWEA Reading Growth': [],
-        'NWEA Math Growth': [],
-        'Reading Growth 3rd' : [],
-        'Reading Growth 4th' : [],
-        'Reading Growth 5th' : [],
-        'Reading Growth 6th' : [],
-        'Reading Growth 7th' : [],
-        'Reading Growth 8th' : [],
-        'Reading Growth All' : [],
-        'Math Growth 3rd' : [],
-        'Math Growth 4th': [],
-        'Math Growth 5th' : [],
-        'Math Growth 6th' : [],
-        'Math Growth 7th' : [],
-        'Math Growth 8th' : [],
-        'Math Growth All' : [],
-        'Reading Attainment 2nd' : [],
-        'Reading Attainment 3rd' : [],
-        'Reading Attainment 4th' : [],
-        'Reading Attainment 5th' : [],
-        'Reading Attainment 6th' : [],
-        'Reading Attainment 7th' : [],
-        'Reading Attainment 8th' : [],
-        'Reading Attainment All' : [],
-        'Math Attainment 2nd' : [],
-        'Math Attainment 3rd' : [],
-        'Math Attainment 4th' : [],
-        'Math Attainment 5th' : [],
-        'Math Attainment 6th' : [],
-        'Math Attainment 7th' : [],
-        'Math Attainment 8th' : [],
-        'Math Attainment All' : [],
-        'lInvolvedFamilies': [],
-        'lAmbitiousInstruction': [],
-        'lSupportiveEnvironment': [],
-        'lEffectiveLeaders': [],
-        'lCollaborativeTeachers': [],
-        'lSchoolCommunity': [],
-        'lParentTeacherPartnership': [],
-        'lQualityofFacilities': [],
-        'lSafety': [],
-        'lSuspensionsYR1': [],
-        'lSuspensionsYR2': [],
-        'lSuspensionsAverage': [],
-        'lMisconductsYR1': [],
-        'lMisconductsYR2': [],
-        'lMisconductsAverage': [],
-        'lSuspensionLengthYR1': [],
-        'lSuspensionLengthYR2': [],
-        'lSuspensionLengthAverage': [],
-        'lStudentAttendanceYR1': [],
-        'lStudentAttendanceYR2': [],
-        'lStudentAttendanceAverage': [],
-        'lTeacherAttendanceYR1': [],
-        'lTeacherAttendanceYR2': [],
-        'lTeacherAttendanceAverage': []}
-
-#This creates the dictionary to change column titles after we have created a pandas dataframe with all of our data
+#The columns of the CSV we will create, in the order they are written
+#scrape_page fills these in for each school using the names the CPS website uses, they are renamed in the header with rename_dict
+columns = ['School ID', 'OfficialSchoolName', 'School Prefix', 'Address', 'lPhone', 'lFax', 'Website',
+    'OverallRating', 'RatingStatus', 'SchoolGradeText', 'NumberOfStudents', 'SchoolType',
+    'SchoolAdministrator', 'SchoolAdministratorTitle', 'SecondaryContact', 'SecondaryContactTitle', 'Hours',
+    'EarliestDropOffTime', 'AfterSchoolHours', 'Transit', 'Kindergarten', 'BilingualServices',
+    'ClassroomLanguages', 'Uniform', 'AttendanceBoundaries', 'RefugeeServices', 'Title1Eligible', 'Asian',
+    'Black', 'Hispanic', 'White', 'Other', 'Low Income', 'Diverse Learners', 'Limited English',
+    'Mobility Rate', 'Chronic Truancy', 'lStudentGrowth', 'lStudentAttainment', 'lCultureClimate',
+    'NWEA Reading Growth', 'NWEA Math Growth', 'Reading Growth 3rd', 'Reading Growth 4th',
+    'Reading Growth 5th', 'Reading Growth 6th', 'Reading Growth 7th', 'Reading Growth 8th',
+    'Reading Growth All', 'Math Growth 3rd', 'Math Growth 4th', 'Math Growth 5th', 'Math Growth 6th',
+    'Math Growth 7th', 'Math Growth 8th', 'Math Growth All', 'Reading Attainment 2nd',
+    'Reading Attainment 3rd', 'Reading Attainment 4th', 'Reading Attainment 5th', 'Reading Attainment 6th',
+    'Reading Attainment 7th', 'Reading Attainment 8th', 'Reading Attainment All', 'Math Attainment 2nd',
+    'Math Attainment 3rd', 'Math Attainment 4th', 'Math Attainment 5th', 'Math Attainment 6th',
+    'Math Attainment 7th', 'Math Attainment 8th', 'Math Attainment All', 'lInvolvedFamilies',
+    'lAmbitiousInstruction', 'lSupportiveEnvironment', 'lEffectiveLeaders', 'lCollaborativeTeachers',
+    'lSchoolCommunity', 'lParentTeacherPartnership', 'lQualityofFacilities', 'lSafety', 'lSuspensionsYR1',
+    'lSuspensionsYR2', 'lSuspensionsAverage', 'lMisconductsYR1', 'lMisconductsYR2', 'lMisconductsAverage',
+    'lSuspensionLengthYR1', 'lSuspensionLengthYR2', 'lSuspensionLengthAverage', 'lStudentAttendanceYR1',
+    'lStudentAttendanceYR2', 'lStudentAttendanceAverage', 'lTeacherAttendanceYR1', 'lTeacherAttendanceYR2',
+    'lTeacherAttendanceAverage']
+col_index = {col: index for index, col in enumerate(columns)} #where each column is in a row
+
+class SchoolRecord:
+    '''
+    One school's row of the CSV, with a value for every column (a list in the order of columns)
+    Every value is 'Not Listed' until scrape_page fills it in
+    '''
+    __slots__ = ['values']
+
+    def __init__(self, school_id):
+        '''
+        Inputs: school_id: the school's ID from its url
+        '''
+        self.values = ['Not Listed'] * len(columns)
+        self['School ID'] = school_id
+
+    def __setitem__(self, key, value):
+        self.values[col_index[key]] = value
+
+    def __contains__(self, key):
+        return key in col_index
+
+#This creates the dictionary to change column titles when we write the header of the CSV
 rename_dict = {'OfficialSchoolName': 'School Name',
         'lPhone': 'School Phone Number', 
         'lFax': 'School Fax Number',
@@ -158,28 +108,115 @@ rename_dict = {'OfficialSchoolName': 'School Name',
         'lStudentAttendanceAverage': 'Student Attendance on Average',
         'lTeacherAttendanceAverage': 'Teacher Attendance on Average'}
 
-def go(year):
+def go(year, use_browser=False, resume=False):
     '''
     Crawls through the initial CPS webpage to gather the URLs to scrape and then calls functions to scrape CPS data
+    The list of URLs and every finished school are saved to a checkpoint file as we go,
+    so if the scraper stops partway through it can pick up where it left off
     
-    Inputs: year: the current year as a string
+    Inputs:
+        year: the current year as a string
+        use_browser: if True, the list of schools is clicked through in Chrome instead of being requested directly
+        resume: if True, uses the checkpoint from an earlier run and only scrapes schools that are not finished
     '''
-    url_lst = shf.loop_through_pages()
-    for index, url in enumerate(url_lst):
-        print(index)
-        data['School ID'].append(url[-6:])  #we get the school ID from the url
-        cur_len = len(data['School ID'])
-        scrape_page(url, data) #scrapes the individual school's page
-        for key, lst in data.items(): #makes sure that all data is filled in
-            if len(lst) < cur_len:
-                data[key].append('Not Listed')
-
-    df = pd.DataFrame(data=data) #Creates a dataframe with our object
+    checkpoint_name = 'cps_checkpoint_' + year + '.jsonl'
+    url_lst, complete, done = None, False, {}
+    if resume and os.path.exists(checkpoint_name):
+        url_lst, complete, done = load_checkpoint(checkpoint_name)
+    if not complete: #a new run, or some pages of the list of schools could not be downloaded last time
+        found_lst, complete = find_schools(use_browser)
+        url_lst = list(dict.fromkeys((url_lst or []) + found_lst)) #keeps the schools found last time in case their page fails now
+        with open(checkpoint_name, 'a' if resume else 'w') as checkpoint: #a resumed run keeps its finished schools
+            save_line(checkpoint, {'urls': url_lst, 'complete': complete})
+    print('%d schools already finished, %d to go' %(len(done), len(url_lst) - len(done)))
+
     change_rename_dict(year) #updates the rename dictionary to incorporate the appropriate years
-    df.rename(columns=rename_dict, inplace=True)
-    df.to_csv('cps_data_' + year +'.csv')
-    
-    shf.delete_lst([df, url_lst, year, url]) #Deleting references to objects we do not need
+    header = [''] + [rename_dict.get(col, col) for col in columns] #the first column is the row number
+
+    with open('cps_data_' + year +'.csv', 'w', newline='') as f, open(checkpoint_name, 'a') as checkpoint:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        row_num = 0
+        for url in url_lst: #the schools finished in an earlier run go first
+            if url[-6:] in done:
+                writer.writerow([row_num] + done[url[-6:]])
+                row_num += 1
+
+        to_scrape = [url for url in url_lst if url[-6:] not in done]
+        #pages are downloaded a few at a time in the background, but we get them back in the order of url_lst
+        for index, (url, tree) in enumerate(shf.fetch_pages(to_scrape)):
+            print(index)
+            if tree is None: #the page could not be downloaded, it is listed at the end and tried again on resume
+                continue
+            record = SchoolRecord(url[-6:]) #we get the school ID from the url
+            scrape_page(url, record, tree) #scrapes the individual school's page
+            save_line(checkpoint, {'School ID': url[-6:], 'row': record.values})
+            writer.writerow([row_num] + record.values) #each school is saved as soon as it is scraped
+            f.flush()
+            row_num += 1
+
+    shf.report_failures()
+    if not complete:
+        print('Some pages of the list of schools could not be downloaded, run again with --resume to look for their schools')
+    elif shf.failed_urls:
+        print('Run again with --resume to try these schools again')
+    shf.delete_lst([header, url_lst, year, done]) #Deleting references to objects we do not need
+
+def find_schools(use_browser=False):
+    '''
+    Gets the list of school urls from the CPS website
+
+    Inputs: use_browser: if True, the list of schools is clicked through in Chrome instead of being requested directly
+
+    Returns:
+        url_lst: a list of individual school urls
+        complete: False if a page of the list could not be downloaded, so some schools may be missing
+    '''
+    if use_browser:
+        return shf.loop_through_pages(), True #Chrome stops with an error instead of skipping a page
+    url_lst = shf.loop_through_pages_http()
+    complete = not any(url.startswith(shf.starting_url) for url in shf.failed_urls)
+    return url_lst, complete
+
+def save_line(checkpoint, item):
+    '''
+    Adds a line to the checkpoint file and makes sure it is on the disk before we move on
+
+    Inputs:
+        checkpoint: the open checkpoint file
+        item: a dictionary to save as one line of JSON
+    '''
+    checkpoint.write(json.dumps(item) + '\n')
+    checkpoint.flush()
+    os.fsync(checkpoint.fileno())
+
+def load_checkpoint(checkpoint_name):
+    '''
+    Reads the checkpoint saved by an earlier run
+    The first line is the list of urls and each line after it is a finished school
+    If the list was looked for again on a resumed run, the newest list is used
+    A line that was only half written when the scraper stopped is skipped
+
+    Inputs: checkpoint_name: the name of the checkpoint file
+
+    Returns:
+        url_lst: the list of school urls
+        complete: False if the list is missing or some of its pages could not be downloaded
+        done: a dictionary of School ID: the school's row
+    '''
+    url_lst, complete, done = None, False, {}
+    with open(checkpoint_name) as checkpoint:
+        for line in checkpoint:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue
+            if 'urls' in item:
+                url_lst = item['urls']
+                complete = item.get('complete', True) and len(url_lst) > 0 #an empty list means the first page failed
+            elif len(item['row']) == len(columns): #rows saved before the columns changed are scraped again
+                done[item['School ID']] = item['row']
+    return url_lst, complete, done
 
 def change_rename_dict(year):
     '''
@@ -198,6 +235,13 @@ def change_rename_dict(year):
     
     shf.delete_lst([y, label, clean_year, clean_label])
 
-go(year='2019')
-gc.collect() #Collects the garbage
-print('Complete')
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scrapes data about all schools from the CPS website')
+    parser.add_argument('--year', default='2019', help='the current year')
+    parser.add_argument('--resume', action='store_true', help='pick up where an earlier run stopped')
+    parser.add_argument('--use-browser', action='store_true', help='click through the list of schools in Chrome')
+    args = parser.parse_args()
+
+    go(year=args.year, use_browser=args.use_browser, resume=args.resume)
+    gc.collect() #Collects the garbage
+    print('Complete')
@@ -62,25 +62,63 @@ Data I have chosen to exclude:
 '''
 #Downloads needed for this section of the code
 import scraping_helper_functions as shf
+from lxml import etree
 
-def scrape_page(url, data):
+#The beginning of the id of every span tag we want, the identifying part of the id comes after it
+span_prefix = 'ctl00_ContentPlaceHolder1_lb'
+website_id = 'ctl00_ContentPlaceHolder1_lnkSchoolWebsite'
+transit_ids = {'lTransitEmpty', 'Train', 'Bus', 'Metra'} #all of these go into one Transit string
+
+#Initializes the dictionary which stores which prefixes we will use for each bar chart
+prefix_dict = {"ctl00_ContentPlaceHolder1_pnlDemographicsChart": [''],\
+    "ctl00_ContentPlaceHolder1_pnlStatisticsChart": [''],\
+    "ctl00_ContentPlaceHolder1_liElementarySchoolCharts": [''],\
+    "ctl00_ContentPlaceHolder1_pnlGrowthES": ['Reading Growth ', 'Math Growth '], \
+    "ctl00_ContentPlaceHolder1_pnlAttainES": ['Reading Attainment ', 'Math Attainment ']}
+
+#These are compiled once and used on every bar chart
+#value_path finds the percents/percentiles and label_path finds the names of the columns they map to
+value_path = etree.XPath(".//span[contains(concat(' ', normalize-space(@class), ' '), ' value ')]")
+label_path = etree.XPath(".//div[contains(concat(' ', normalize-space(@class), ' '), ' bar-lefttext ')"
+    " or @class='panel-body text-bold grey-darkest']")
+
+def scrape_page(url, data, tree=None):
     '''
     Scrapes a single page for data about a school
+    The page is walked through once and each tag with an id we want is sent to the function that handles it
     
     Inputs: 
         url: url of the page we want to scrape
-        data: a dictionary with the information we want to add to
+        data: the school's SchoolRecord (from cps_data_2019) that we will fill in
+        tree: an lxml tree of the page if it has already been downloaded
     '''
-    soup = shf.create_soup(url) #creates BeautifulSoup object from url
-    get_bar_chart_data(soup, data) #gets data stored in a bar chart on the school's page
-    get_span_data(soup, data) #gets data stored in span tags
-    data['Website'].append(get_a_data(soup)) #gets data stored in a tags (just the website)
+    if tree is None:
+        tree = shf.create_tree(url) #creates an lxml tree from url
+    if tree is None: #the page could not be downloaded
+        return None
+
+    page = {'transit': [], 'website': 'Not Listed'} #things we put together from more than one tag
+    for instance in tree.iter('div', 'span', 'a'):
+        inst_id = instance.get('id')
+        if inst_id is None: #we only want elements with ids
+            continue
+        if inst_id in prefix_dict:
+            if instance.tag == 'div':
+                get_bar_chart_data(instance, data) #gets data stored in a bar chart on the school's page
+        elif inst_id.startswith(span_prefix):
+            if instance.tag == 'span':
+                get_span_data(instance, inst_id[len(span_prefix):], data, page) #gets data stored in span tags
+        elif inst_id == website_id and instance.tag == 'a' and page['website'] == 'Not Listed':
+            page['website'] = instance.text_content() #gets data stored in a tags (just the website)
 
-    shf.delete_lst([soup])
+    data['Transit'] = ', '.join(page['transit']) #puts all transit options into the school's record
+    data['Website'] = page['website']
 
-def get_bar_chart_data(soup, data):
+    shf.delete_lst([tree, page])
+
+def get_bar_chart_data(chart, data):
     '''
-    Gets data stored in bar charts, this includes:
+    Gets data stored in a bar chart, this includes:
         % Asian
         % Black
         % Hispanic
@@ -95,64 +133,29 @@ def get_bar_chart_data(soup, data):
         Reading/Math Growth/Attainmnet by grade
     
     Inputs:
-        soup: a BeautifulSoup object
-        data: a dictionary we will add to
+        chart: the lxml div element of the bar chart (its id is in prefix_dict)
+        data: the school's SchoolRecord that we will fill in
     '''
-    #Initializes the dictionary which stores which prefixes we will use
-    prefix_dict = {"ctl00_ContentPlaceHolder1_pnlDemographicsChart": [''],\
-        "ctl00_ContentPlaceHolder1_pnlStatisticsChart": [''],\
-        "ctl00_ContentPlaceHolder1_liElementarySchoolCharts": [''],\
-        "ctl00_ContentPlaceHolder1_pnlGrowthES": ['Reading Growth ', 'Math Growth '], \
-        "ctl00_ContentPlaceHolder1_pnlAttainES": ['Reading Attainment ', 'Math Attainment ']}
-    
-    #Searches for div tags who have the listed ids
-    for instance in soup.find_all(['div'], id=["ctl00_ContentPlaceHolder1_pnlDemographicsChart",\
-        "ctl00_ContentPlaceHolder1_pnlStatisticsChart","ctl00_ContentPlaceHolder1_liElementarySchoolCharts",\
-        "ctl00_ContentPlaceHolder1_pnlGrowthES", "ctl00_ContentPlaceHolder1_pnlAttainES"]):
-        
-        i = 0 #an index which will only be used to ensure we are using the appropriate prefix
-        prefix_lst = prefix_dict[instance['id']]
-
-        pct_lst = [] #holds the numbers we scrape
-        key_lst = [] #holds the names of the columns we want the numbers to map to in the data dictionary
-        
-        #Searches for span tags who have the listed ids, this will give us the percents/percentiles
-        for percent in instance.find_all(['span'], class_=["value" ,"value bold", "value bold value-behind"]):
-            per = percent.get_text().strip()
-            pct_lst.append(per)
-        
-        #Searches for div tags who have the listed ids, this will give us the columns names
-        for demographic in instance.find_all(['div'], class_=["bar-lefttext","panel-body text-bold grey-darkest"]):
-            key = demographic.get_text().strip('\n?').strip()
-            if key.endswith('percentile'): #formats the name in a way we like
-                key = key[:21].strip()
-            key_lst.append(prefix_lst[i] + key)
-            if key == 'All': #'All' comes at the end of a bar chart and we then need to use a different prefix
-                i += 1
+    i = 0 #an index which will only be used to ensure we are using the appropriate prefix
+    prefix_lst = prefix_dict[chart.get('id')]
 
-        for index, per in enumerate(pct_lst): #loops through the percent list with its index
-            key = key_lst[index] #the appropriate key will have the same index as the percent
-            data[key].append(per) #add the data to the dictionary
+    pct_lst = [percent.text_content().strip() for percent in value_path(chart)] #holds the numbers we scrape
+    key_lst = [] #holds the names of the columns we want the numbers to map to in the record
+    for demographic in label_path(chart):
+        key = demographic.text_content().strip('\n?').strip()
+        if key.endswith('percentile'): #formats the name in a way we like
+            key = key[:21].strip()
+        key_lst.append(prefix_lst[i] + key)
+        if key == 'All': #'All' comes at the end of a bar chart and we then need to use a different prefix
+            i += 1
 
-    #shf.delete_lst([instance, percent, demographic, per, pct_lst, key_lst, key, prefix_dict, prefix_lst])
+    for index, per in enumerate(pct_lst): #loops through the percent list with its index
+        key = key_lst[index] #the appropriate key will have the same index as the percent
+        data[key] = per #add the data to the school's record
 
-def get_a_data(soup):
+def get_span_data(span, end_id, data, page):
     '''
-    Gets the data that is held in a tags, this includes the school website
-    
-    Inputs: 
-        soup: a BeautifulSoup object
-
-    Returns:
-       the school's website or 'Not Listed' if there is no data
-    '''
-    for instance in soup.find_all(['a'], id=['ctl00_ContentPlaceHolder1_lnkSchoolWebsite']):
-                return instance.get_text()
-    return 'Not Listed'
-
-def get_span_data(soup, data):
-    '''
-    Gets the data that is held in span tags, this includes:
+    Gets the data that is held in a span tag, this includes:
         School Name
         School Prefix
         School Address
@@ -194,27 +197,19 @@ def get_span_data(soup, data):
         Student/teacher attendance across 2 years and average
     
     Inputs: 
-        soup: a BeautifulSoup object
-        data: a dictionary we will add to
+        span: an lxml span element whose id starts with span_prefix
+        end_id: the identifying part of the id that comes after span_prefix
+        data: the school's SchoolRecord that we will fill in
+        page: a dictionary of things we are putting together from more than one tag
     '''
-    transit_options = ''
-    for instance in soup.find_all(['span']): #searches for all span tags
-        if instance.has_attr('id'): #we only want elements with ids
-            inst_id = instance['id']
-            #We only want instances where the id begins with the listed string
-            if inst_id.startswith('ctl00_ContentPlaceHolder1_lb'):
-                end_id = inst_id[28:] #the identifying part of the id comes after the beginning of the string listed above
-                if end_id == 'OfficialSchoolName': #We need to pull two things out of the text under this id
-                    prefix = 'None'
-                    name = instance.get_text()
-                    if ' - ' in name:
-                        prefix, name = name.split(' - ',  1) #splits the name into two parts
-                    data['School Prefix'].append(prefix)
-                    data[end_id].append(name)
-                elif end_id in data: #puts the data in the dictionary if the key is in the dictionary
-                    data[end_id].append(instance.get_text())
-                elif end_id in ['lTransitEmpty', 'Train', 'Bus', 'Metra']: #puts all transit options in a string
-                    transit_options += instance.get_text() + ', '
-
-    data['Transit'].append(transit_options[:-2]) #puts all transit options into the data dictionary without the extra comma at the end
-    #shf.delete_lst([inst_id, end_id, instance, prefix, name])
+    if end_id == 'OfficialSchoolName': #We need to pull two things out of the text under this id
+        prefix = 'None'
+        name = span.text_content()
+        if ' - ' in name:
+            prefix, name = name.split(' - ',  1) #splits the name into two parts
+        data['School Prefix'] = prefix
+        data[end_id] = name
+    elif end_id in data: #puts the data in the record if the record has that column
+        data[end_id] = span.text_content()
+    elif end_id in transit_ids: #puts all transit options in a string
+        page['transit'].append(span.text_content())
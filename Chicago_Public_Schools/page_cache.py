@@ -0,0 +1,269 @@
+'''
+Author: Esther Edith Spurlock
+
+Saves downloaded pages to disk so that running a scraper again does not download every page again
+
+Each page is saved once under the hash of its contents, and cache_index.json remembers which url goes with which page.
+A saved page is used without asking the website if it is younger than max_age.
+Older pages are checked with the website (using ETag/Last-Modified) and only downloaded again if they changed.
+If the saved pages take more than max_bytes, the pages that were used least recently are deleted.
+Set offline to True to only use saved pages and never go to the website.
+
+This is used by scraping_helper_functions and by Chicago_Health_Data/health_data_scraper.py
+'''
+#Downloads needed for this section of the code
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+
+cache_dir = 'page_cache' #the folder the pages are saved in
+max_age = 7 * 24 * 60 * 60 #seconds a saved page is used without checking with the website (one week)
+max_bytes = 500 * 1024 * 1024 #the most space the saved pages can take (500 MB)
+save_every = 100 #the index is saved after this many pages are used from the cache (and when Python exits)
+offline = False #if True, only saved pages are used
+
+index = None #url: information about the saved page, loaded from cache_index.json the first time it is needed
+lock = threading.Lock() #the scrapers download pages from many threads at once
+evicted = set() #urls this process deleted from the cache, so save_index does not bring them back from the file
+unsaved = 0 #the number of times a page was used since the index was last saved
+
+def get_text(url, download):
+    '''
+    Gets the text of a page, from the cache if we can
+
+    Inputs:
+        url: the url of the page
+        download: a function that takes a url and a dictionary of headers and returns a requests Response object
+            (or None if the page could not be downloaded)
+
+    Returns: the text of the page or None if it is not saved and could not be downloaded
+    '''
+    body, encoding = get_body(url, download)
+    if body is None:
+        return None
+    return body.decode(encoding or 'iso-8859-1', 'replace')
+
+def get_content(url, download):
+    '''
+    Gets the contents of a page as bytes, from the cache if we can
+    Parsers like lxml read the page's own encoding declaration from the bytes
+
+    Inputs: the same as get_text
+
+    Returns: the contents of the page as bytes or None if it is not saved and could not be downloaded
+    '''
+    return get_body(url, download)[0]
+
+def get_body(url, download):
+    '''
+    Gets the contents of a page and its encoding, from the cache if we can
+    If the saved page is too old, we ask the website if it changed and only download it again if it did
+
+    Inputs: the same as get_text
+
+    Returns: (the contents of the page as bytes, its encoding) or (None, None) if it is not saved and could not be downloaded
+    '''
+    entry = lookup(url)
+    if entry is not None and (offline or time.time() - entry['fetched'] < max_age):
+        return read_body(url, entry), entry['encoding']
+    if offline:
+        return None, None
+
+    headers = {} #lets the website tell us the page did not change instead of sending it again
+    if entry is not None and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry is not None and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+
+    req = download(url, headers)
+    if req is None: #an old copy is better than nothing
+        return (read_body(url, entry), entry['encoding']) if entry is not None else (None, None)
+    if req.status_code == 304: #the page did not change
+        with lock:
+            entry['fetched'] = time.time()
+        return read_body(url, entry), entry['encoding']
+
+    store(url, req.content, req.encoding, req.headers.get('ETag'), req.headers.get('Last-Modified'))
+    return req.content, req.encoding
+
+def get_rendered(key, render):
+    '''
+    Gets a page that has to be loaded in a browser, from the cache if we can
+    Browsers cannot ask the website if a page changed, so pages older than max_age are loaded again
+
+    Inputs:
+        key: a name for the page, usually the url
+        render: a function that takes no inputs and returns the page source from the browser
+            (or None if the page did not load, so a broken page is not saved)
+
+    Returns: the page source or None
+    '''
+    entry = lookup(key)
+    if entry is not None and (offline or time.time() - entry['fetched'] < max_age):
+        return read_body(key, entry).decode('utf-8', 'replace')
+    if offline:
+        return None
+
+    page_source = render()
+    if page_source is not None: #render gives None for a page that did not finish loading, so it is not saved
+        store(key, page_source.encode('utf-8'), 'utf-8', None, None)
+    return page_source
+
+def load_index():
+    '''
+    Loads the index of saved pages from disk the first time it is needed
+
+    Returns: the index dictionary
+    '''
+    global index
+    if index is None:
+        os.makedirs(cache_dir, exist_ok=True)
+        index_name = os.path.join(cache_dir, 'cache_index.json')
+        if os.path.exists(index_name):
+            with open(index_name) as f:
+                index = json.load(f)
+        else:
+            index = {}
+    return index
+
+def save_index():
+    '''
+    Saves the index of saved pages to disk, writing to a new file first so a crash cannot leave half an index
+    Other processes (like the Health Atlas workers) may have saved pages too, so their entries are kept,
+    but not the pages this process deleted or pages whose file is gone
+    The lock must be held when this is called
+    '''
+    global unsaved
+    index_name = os.path.join(cache_dir, 'cache_index.json')
+    if os.path.exists(index_name):
+        with open(index_name) as f:
+            for url, entry in json.load(f).items():
+                if url in evicted or not os.path.exists(body_path(entry['hash'])):
+                    continue
+                if url not in index or index[url]['used'] < entry['used']:
+                    index[url] = entry
+    tmp_name = index_name + '.tmp' + str(os.getpid()) #each process writes its own temporary file
+    with open(tmp_name, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_name, index_name)
+    unsaved = 0
+
+def flush():
+    '''
+    Saves the index if pages were used since it was last saved
+    This runs when Python exits, worker processes should call it before they exit
+    '''
+    with lock:
+        if index is not None and unsaved > 0:
+            save_index()
+
+atexit.register(flush)
+
+def lookup(url):
+    '''
+    Finds the saved page for a url and makes sure its file still exists
+
+    Inputs: url: the url of the page
+
+    Returns: the index entry for the page or None if it is not saved
+    '''
+    with lock:
+        entry = load_index().get(url)
+        if entry is not None and not os.path.exists(body_path(entry['hash'])):
+            del index[url]
+            entry = None
+    return entry
+
+def body_path(body_hash):
+    '''
+    Inputs: body_hash: the hash of a page's contents
+
+    Returns: the name of the file the page is saved in
+    '''
+    return os.path.join(cache_dir, body_hash + '.html')
+
+def read_body(url, entry):
+    '''
+    Reads a saved page and marks it as just used
+    The index is saved every save_every pages (and by flush), so the next run knows when pages were used and checked
+
+    Inputs:
+        url: the url of the page
+        entry: the index entry for the page
+
+    Returns: the contents of the page as bytes
+    '''
+    global unsaved
+    with open(body_path(entry['hash']), 'rb') as f:
+        body = f.read()
+    with lock:
+        entry['used'] = time.time()
+        unsaved += 1
+        if unsaved >= save_every:
+            save_index()
+    return body
+
+def store(url, body, encoding, etag, last_modified):
+    '''
+    Saves a page and deletes the least recently used pages if the cache is too big
+    The url's older version is deleted if no other url has the same contents
+
+    Inputs:
+        url: the url of the page
+        body: the page's contents as bytes
+        encoding: the encoding of body
+        etag, last_modified: what the website said about this version of the page (can be None)
+    '''
+    body_hash = hashlib.sha256(body).hexdigest()
+    if not os.path.exists(body_path(body_hash)): #pages with the same contents are only saved once
+        tmp_name = body_path(body_hash) + '.tmp' + str(os.getpid()) + '-' + str(threading.get_ident())
+        with open(tmp_name, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_name, body_path(body_hash))
+
+    now = time.time()
+    with lock:
+        old = load_index().get(url)
+        index[url] = {'hash': body_hash, 'size': len(body), 'encoding': encoding, 'etag': etag,
+            'last_modified': last_modified, 'fetched': now, 'used': now}
+        evicted.discard(url)
+        if old is not None and old['hash'] != body_hash:
+            remove_body(old['hash'])
+        evict()
+        save_index()
+
+def evict():
+    '''
+    Deletes the least recently used pages until the cache takes no more than max_bytes
+    A file is only deleted once no url uses it anymore
+    The lock must be held when this is called
+    '''
+    sizes = {entry['hash']: entry['size'] for entry in index.values()}
+    total = sum(sizes.values())
+    for url, entry in sorted(index.items(), key=lambda item: item[1]['used']):
+        if total <= max_bytes:
+            break
+        del index[url]
+        evicted.add(url)
+        if remove_body(entry['hash']):
+            total -= entry['size']
+
+def remove_body(body_hash):
+    '''
+    Deletes a saved page's file if no url in the index uses it anymore
+    The lock must be held when this is called
+
+    Inputs: body_hash: the hash of the page's contents
+
+    Returns: True if the file is no longer in the cache
+    '''
+    if any(entry['hash'] == body_hash for entry in index.values()):
+        return False
+    try:
+        os.remove(body_path(body_hash))
+    except FileNotFoundError: #another process may have deleted it already
+        pass
+    return True
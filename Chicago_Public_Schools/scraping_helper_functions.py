@@ -5,39 +5,190 @@ Helper functions to help with scraping data from the web
 '''
 #Downloads needed for this section of the code
 import bs4
+import lxml.etree
+import lxml.html
 from selenium import webdriver
 import requests
-import sys
+import page_cache
+from requests.adapters import HTTPAdapter
 import gc
+import time
+import random
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 #This is the pathway to ChromeDriver on my machine. You will need to update this path to match where ChromeDriver is on your machine
 chrome_path = 'C:/Users/eespu/AppData/Local/Programs/Python/Python37/Lib/site-packages/selenium/webdriver/chrome/chromedriver'
 #The URL that points to the first page with the list of schools
 #This URL worked as of summer 2019. It may have to be changed
 starting_url = 'https://schoolinfo.cps.edu/schoolprofile/SearchResults.aspx'
+#How many pages we download at the same time and how many requests we send per second across all of them
+#Please keep these low so we do not overload the CPS website
+max_workers = 8
+requests_per_second = 5
+#Settings for the connections we keep open to the website
+pool_size = max_workers #the number of connections kept open, one for each worker
+timeout = (5, 30) #seconds to wait to connect and to wait for the page
+max_retries = 4 #the number of times we try a page again after a temporary error
+backoff = 1 #seconds to wait before the first retry, this doubles every retry
+retry_statuses = [429, 500, 502, 503, 504] #responses that mean the website is having temporary trouble
+
+#The name of the table of schools on the search page, clicking a page number sends this back to the website
+pager_target = 'ctl00$ContentPlaceHolder1$gvSchoolSearchResults'
+
+session = None #shared by every request so connections are reused instead of opened for every page
+failed_urls = {} #url: why we could not get the page
         
+def get_session():
+    '''
+    Gets the shared requests Session, creating it the first time
+    The Session keeps connections to the website open so each page does not need a new connection
+
+    Returns: a requests Session object
+    '''
+    global session
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+    return session
+
+def get_page(url, headers=None, form=None):
+    '''
+    Downloads a page (or sends a form to it), trying again after temporary errors (timeouts, dropped connections, and the retry_statuses)
+    Each retry waits a random time up to backoff * 2^retry seconds so retries do not all happen at once
+    If the page cannot be downloaded, the reason is saved in failed_urls
+
+    Inputs:
+        url: the url you want to download
+        headers: a dictionary of extra headers to send, if any
+        form: a dictionary of form fields to POST, if None the page is downloaded with a GET
+
+    Returns: the requests Response object or None if the page could not be downloaded
+    '''
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+        try:
+            if form is None:
+                req = get_session().get(url, headers=headers, timeout=timeout)
+            else:
+                req = get_session().post(url, headers=headers, data=form, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as err:
+            reason = type(err).__name__
+            continue
+        if req.status_code in retry_statuses:
+            reason = 'HTTP ' + str(req.status_code)
+            continue
+        if req:
+            failed_urls.pop(url, None) #in case an earlier try of this url failed
+            return req
+        reason = 'HTTP ' + str(req.status_code) #other errors (like 404) will not go away if we try again
+        break
+
+    failed_urls[url] = reason
+    return None
+
 def create_soup(url):
     '''
     Creates a BeautifulSoup object of the CPS all schools list
     
     Inputs: the url you want to scrape
     
-    Returns: a BeautifulSoup object
+    Returns: a BeautifulSoup object or None if the page could not be downloaded
     '''
-    req = requests.get(url) #Creating the request object
-    if req:
-        req_en = req.text.encode('iso-8859-1', 'ignore') #Encode the request object
-    else:
-        sys.exit("Not a valid request object")
+    text = page_cache.get_text(url, get_page) #Uses the saved page if it has not changed, otherwise downloads it
+    if text is None:
+        return None
+    req_en = text.encode('iso-8859-1', 'ignore') #Encode the page
     
-    soup = bs4.BeautifulSoup(req_en, features="html.parser") #Turning the request object into a BeautifulSoup object
+    soup = bs4.BeautifulSoup(req_en, features="html.parser") #Turning the page into a BeautifulSoup object
+    delete_lst([text, req_en]) #Deleting references to objects we do not need
+    return soup
+
+def report_failures():
+    '''
+    Prints every page we could not download (or parse) and why
+    '''
+    if failed_urls:
+        print('Could not download or parse %d pages:' %len(failed_urls))
+    for url, reason in failed_urls.items():
+        print(url, reason)
+
+class RateLimiter:
+    '''
+    Makes sure no more than rate requests are started per second, no matter how many threads are sending them
+    '''
+    def __init__(self, rate):
+        '''
+        Inputs: rate: the number of requests allowed per second
+        '''
+        self.interval = 1.0 / rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        '''
+        Waits until it is this thread's turn to send a request
+        '''
+        with self.lock: #each thread takes the next open time slot
+            now = time.monotonic()
+            my_time = max(now, self.next_time)
+            self.next_time = my_time + self.interval
+        time.sleep(max(0, my_time - now))
+
+def create_tree(url, limiter=None):
+    '''
+    Creates an lxml tree of a page, lxml parses pages much faster than BeautifulSoup's html.parser
+
+    Inputs:
+        url: the url you want to scrape
+        limiter: a RateLimiter to wait on before going to the website (saved pages do not wait), if any
+
+    Returns: an lxml HtmlElement or None if the page could not be downloaded or parsed
+    '''
+    def download(url, headers):
+        if limiter is not None:
+            limiter.wait()
+        return get_page(url, headers)
 
-    if soup:
-        delete_lst([req, req_en]) #Deleting references to objects we do not need
-        return soup
-    else:
-        del soup
-        sys.exit("Not a valid soup object")
+    content = page_cache.get_content(url, download) #Uses the saved page if it has not changed, otherwise downloads it
+    if content is None:
+        return None
+    try:
+        return lxml.html.fromstring(content) #bytes, so lxml can use the page's own encoding declaration
+    except (lxml.etree.ParserError, ValueError) as err: #e.g. an empty page, one bad page does not stop the others
+        failed_urls[url] = 'could not parse the page: ' + repr(err)
+        return None
+
+def fetch_pages(url_lst, workers=max_workers, rate=requests_per_second):
+    '''
+    Downloads many pages at the same time and parses them into lxml trees
+    The trees are given back in the same order as url_lst, no matter which page finished downloading first
+    Only a few pages are downloaded ahead of the one being used, so memory does not grow with the number of pages
+
+    Inputs:
+        url_lst: a list of urls to scrape
+        workers: the number of pages to download at the same time
+        rate: the most requests to send per second
+
+    Returns: a generator of (url, lxml tree) in the same order as url_lst
+    '''
+    limiter = RateLimiter(rate)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for url in url_lst:
+            pending.append((url, pool.submit(create_tree, url, limiter)))
+            if len(pending) >= 2 * workers: #keeps the workers busy while we use the oldest page
+                url, future = pending.popleft()
+                yield url, future.result()
+        while pending:
+            url, future = pending.popleft()
+            yield url, future.result()
 
 def delete_lst(del_lst):
     '''
@@ -81,6 +232,78 @@ def loop_through_pages():
     delete_lst([browser, soup, x_path, x_path_origin, page, i, start, end, end_dict])
     return url_lst
 
+def loop_through_pages_http():
+    '''
+    loops through all the pages of the CPS website to collect all individual school's url without a browser
+    Clicking a page number on the CPS website sends a form back to the website (an ASP.NET postback),
+    so we send the same form ourselves: the hidden fields from the last page plus the page we want
+    Pages that could not be downloaded are saved in failed_urls as starting_url (the first page) or starting_url + ' Page$<n>'
+
+    Returns: url_lst: a list of individual school urls
+    '''
+    req = get_page(starting_url)
+    if req is None:
+        report_failures()
+        return []
+    soup = bs4.BeautifulSoup(req.text, features="html.parser")
+
+    url_lst = []
+    get_urls(soup, url_lst)
+    seen = {'Page$1'} #the pages we have already visited or plan to visit
+    to_visit = []
+    while True:
+        for page in find_page_args(soup): #adds page numbers we have not seen, including the '...' links to the next set of pages
+            if page not in seen:
+                seen.add(page)
+                to_visit.append(page)
+        if not to_visit:
+            break
+        page = to_visit.pop(0)
+
+        form = get_form_fields(soup)
+        form['__EVENTTARGET'] = pager_target
+        form['__EVENTARGUMENT'] = page
+        req = get_page(starting_url, form=form)
+        if req is None: #this page is listed by report_failures, we keep going with the others
+            #every page is sent to starting_url, so we save the failure under the page too or the next page that works would clear it
+            failed_urls[starting_url + ' ' + page] = failed_urls.pop(starting_url)
+            continue
+        soup = bs4.BeautifulSoup(req.text, features="html.parser")
+        get_urls(soup, url_lst)
+
+    delete_lst([req, soup, seen, to_visit])
+    return list(dict.fromkeys(url_lst)) #takes out duplicates but keeps the order
+
+def get_form_fields(soup):
+    '''
+    Gets the hidden form fields (__VIEWSTATE, __EVENTVALIDATION, ...) the website needs to be sent back
+
+    Inputs: soup: a BeautifulSoup object
+
+    Returns: a dictionary of field names and values
+    '''
+    fields = {}
+    for instance in soup.find_all('input', type='hidden'):
+        if instance.has_attr('name'):
+            fields[instance['name']] = instance.get('value', '')
+    return fields
+
+def find_page_args(soup):
+    '''
+    Finds the page numbers in the pager of the table of schools
+    The pager links look like javascript:__doPostBack('ctl00$ContentPlaceHolder1$gvSchoolSearchResults','Page$2')
+
+    Inputs: soup: a BeautifulSoup object
+
+    Returns: a list of page arguments like 'Page$2'
+    '''
+    page_lst = []
+    for instance in soup.find_all('a', href=True):
+        match = re.search(r"__doPostBack\('([^']*)','(Page\$\d+)'\)", instance['href'])
+        if match and match.group(1) == pager_target: #we skip Next/Last links, they point to pages we find anyway
+            page_lst.append(match.group(2))
+    return page_lst
+
 def get_urls(soup, url_lst):
     '''
     Finds the urls to link to the different schools and updates url_lst
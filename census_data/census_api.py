@@ -3,7 +3,8 @@ Author: Esther Edith Spurlock
 
 Purpose: download data from the census using an API
 
-Not all of the data fit into one csv, so this will split to data into 11 csvs
+The API cannot give us all of the data at once, so it is downloaded in 12 groups and then put together into one table
+(acs5_data.parquet) with a row for every Chicago tract
 
 I downloaded 385 variables, these include:
 
@@ -48,9 +49,16 @@ https://api.census.gov/data/2017/acs/acs1/variables.html
 #importing packages
 import pandas as pd
 import censusdata
+import functools
 import gc
 import re
-from unittest.mock import inplace
+import time
+import random
+import requests
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 #I took this directly from the CensusData pacage documentation. It makes sure you can see all data in a dataframe if you print out the dataframe
 pd.set_option('display.expand_frame_repr', False)
@@ -212,41 +220,493 @@ health_ins_vars_2 = ['B27002_004E', 'B27002_007E', 'B27002_010E', 'B27002_013E',
 
 single_parent_vars = ['B11003_011E', 'B11003_016E']
 
-#This gets a list of the tracts that are in the city of Chicago
-tracts_df = pd.read_csv('CensusTractsTIGER2010.csv')
-tract_lst = tracts_df['TRACTCE10'].tolist()
-
 #These are the numbers we will need to get the correct geospatial data
 IL_num = '17'
 Cook_County_num = '031'
+geo = [('state', IL_num), ('county', Cook_County_num), ('tract', '*')] #every tract in Cook County
+dataset = 'acs5'
+year = 2017
+
+#The census API, change this to point at a different server (e.g. a local copy serving saved responses)
+census_api_url = 'https://api.census.gov/data'
+#Every group we download is saved here, so running again only downloads the groups that are missing or too old
+cache_dir = 'census_cache'
+cache_max_age = 30 * 24 * 60 * 60 #seconds a saved group is used before it is downloaded again (30 days)
+tracts_csv = 'CensusTractsTIGER2010.csv' #the tracts that are in the city of Chicago
+variables_json = 'acs5_2017_variables.json' #a local copy of the list of every variable, downloaded the first time it is needed
+census_table = 'acs5_data.parquet' #every group in one table, end the name with .feather to save a Feather file instead
+#The API allows at most 50 variables per request, and NAME (which we always ask for) is one of them
+max_vars_per_request = 49
 
 vars_lst = [demographic_vars_1, demographic_vars_2, commute_vars, marriage_birth_vars, education_vars, income_vars, assist_housing_vars,
     disability_vars_1, disability_vars_2, health_ins_vars_1, health_ins_vars_2, single_parent_vars]
+#The names of the lists in vars_lst, used when we report which groups worked
+group_names = ['demographic_vars_1', 'demographic_vars_2', 'commute_vars', 'marriage_birth_vars', 'education_vars', 'income_vars',
+    'assist_housing_vars', 'disability_vars_1', 'disability_vars_2', 'health_ins_vars_1', 'health_ins_vars_2', 'single_parent_vars']
 
-i = 0
-#Goes through all of the lists we have created
 #Sometimes, the government API doesn't work well and you need to call something multiple times
-#If it breaks down partway through the list, I tend to just run it again with a smaller vars_lst of the variables we haven't gotten to yet
-for vars in vars_lst:
-    #Get the census data from the API
-    census_data_df = censusdata.download('acs5', 2017,
-        censusdata.censusgeo([('state', IL_num), ('county', Cook_County_num), ('tract', '*')]),
-        vars).rename(columns=rename_dict)
-    #Pulling out the tract number from the index
-    census_data_df['Tract'] = census_data_df.index
-    census_data_df['Tract'] = census_data_df['Tract'].apply(lambda x: int(re.findall(r"\d\d\d\d\d\d", str(x))[0]))
-    #Getting rid of all the tracts we don't want
-    census_data_df = census_data_df[census_data_df['Tract'].isin(tract_lst)]
-    #Saving our data to a CSV
-    csv_name = 'acs5_data_' + str(i) + '.csv'
-    census_data_df.to_csv(csv_name)
-    i += 1
-    print(i)
-
-del census_data_df
-del tracts_df
-del tract_lst
-del vars
-del i
-
-gc.collect()
+max_workers = 12 #the most groups (or requests) we send at the same time, lower this if the API starts refusing requests
+max_retries = 4 #the number of times we try a group again after an error
+backoff = 2 #seconds to wait before the first retry, this doubles every retry
+
+#Filled in from variables_json the first time a variable is looked up, see load_variables
+variables_index = None #variable code: its label, concept, and table
+words_index = None #lowercase word: the set of variable codes with that word in their code, table, label, or concept
+tables_index = None #table ID: the sorted list of estimate variables in that table
+
+def go(groups=None, workers=None, use_cache=True, csvs=False):
+    '''
+    Downloads the groups of variables in vars_lst at the same time and saves them all in one table (census_table)
+    A group that fails is tried again, and at the end we print which groups worked and which did not
+    
+    Inputs:
+        groups: a list of group numbers (indexes in vars_lst) to download, if None every group is downloaded
+            e.g. go(groups=[3, 7]) downloads the groups that failed last time
+            The table needs every group, so other groups that are missing from cache_dir or too old are downloaded (and reported) too
+        workers: the number of groups to download at the same time, if None every group is downloaded at once (up to max_workers)
+            so the run takes about as long as the slowest group
+        use_cache: if True, groups saved in cache_dir are used instead of being downloaded again,
+            so after a partial failure running go() again only downloads the groups that failed
+        csvs: if True, each group is also saved to its own acs5_data_<group number>.csv like before
+
+    Returns: a pandas dataframe with a row for every group saying if it worked
+    '''
+    #This gets a list of the tracts that are in the city of Chicago
+    tracts_df = pd.read_csv(tracts_csv)
+    tract_lst = tracts_df['TRACTCE10'].tolist()
+    if groups is None:
+        groups = range(len(vars_lst))
+    groups = list(groups)
+    #finalize needs every group, so other groups that are missing or too old are downloaded here, with retries and in the report
+    groups += [i for i in range(len(vars_lst)) if i not in groups and not is_cached(dataset, year, geo, vars_lst[i])]
+    #the list of variables is downloaded the first time it is needed, so it is tried again after errors like the groups are
+    variables, attempts, error = retry(load_variables)
+    if error:
+        print('Could not get the list of variables, so they are not checked before downloading: ' + error)
+    else:
+        validate_variables([var for i in groups for var in vars_lst[i]]) #finds bad variables before we ask the API
+
+    if workers is None:
+        workers = min(len(groups), max_workers)
+    download = functools.partial(download_with_retries, tract_lst=tract_lst, use_cache=use_cache, csvs=csvs)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(download, groups))
+
+    report = pd.DataFrame(results, columns=['Group', 'Name', 'Status', 'Source', 'Attempts', 'Seconds', 'Error']).set_index('Group')
+    print(report)
+    failed = report.index[report['Status'] != 'ok'].tolist()
+    if failed:
+        print('To try the failed groups again, run go(groups=%s)' %failed)
+    else: #every group we asked for is saved in the cache, so we can put them all together
+        finalize()
+
+    del tracts_df
+    del tract_lst
+    gc.collect()
+    return report
+
+def download_with_retries(i, tract_lst, use_cache=True, csvs=False):
+    '''
+    Downloads one group, trying again with a longer wait each time if the API gives an error
+    
+    Inputs:
+        i: the group number (index in vars_lst)
+        tract_lst: a list of the tracts in the city of Chicago
+        use_cache: if True, the group is read from cache_dir if it was saved there
+        csvs: if True, the group is also saved to acs5_data_<i>.csv
+
+    Returns: (group number, group name, 'ok' or 'failed', 'cache' or 'api', number of attempts, seconds taken, the last error or '')
+    '''
+    start = time.monotonic()
+    source, attempts, error = retry(download_group, i, tract_lst, use_cache, csvs)
+    status = 'failed' if error else 'ok'
+    return i, group_names[i], status, source or 'api', attempts, round(time.monotonic() - start, 1), error
+
+def retry(func, *args):
+    '''
+    Calls func, trying again with a longer wait each time if it gives an error
+    
+    Inputs:
+        func: the function to call
+        args: the inputs to func
+
+    Returns: (what func returned or None, the number of attempts, the last error or '')
+    '''
+    error = ''
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            time.sleep(random.uniform(0, backoff * 2 ** attempt)) #waits a random time so retries do not all happen at once
+        try:
+            return func(*args), attempt + 1, ''
+        except Exception as err: #the API gives many kinds of errors, all of them are worth trying again
+            error = repr(err)
+    return None, max_retries + 1, error
+
+def download_group(i, tract_lst, use_cache=True, csvs=False):
+    '''
+    Downloads one group of variables into the cache and, if csvs is True, saves it to acs5_data_<i>.csv
+    
+    Inputs:
+        i: the group number (index in vars_lst)
+        tract_lst: a list of the tracts in the city of Chicago
+        use_cache: if True, the group is read from cache_dir if it was saved there
+        csvs: if True, the group is also saved to acs5_data_<i>.csv
+
+    Returns: 'cache' if the group came from cache_dir, 'api' if it was downloaded
+    '''
+    #Get the census data from the API (or from the cache)
+    census_data_df, source = get_acs(dataset, year, geo, vars_lst[i], use_cache)
+    if csvs:
+        census_data_df['Tract'] = census_data_df['tract'].astype(int) #the API gives the tract number in its own column
+        census_data_df = to_censusgeo_index(census_data_df).rename(columns=rename_dict)
+        #Getting rid of all the tracts we don't want
+        census_data_df = census_data_df[census_data_df['Tract'].isin(tract_lst)]
+        #Saving our data to a CSV
+        csv_name = 'acs5_data_' + str(i) + '.csv'
+        census_data_df.to_csv(csv_name)
+    return source
+
+def finalize(groups=None, out_name=census_table):
+    '''
+    Puts every group into one table with a row for every Chicago tract and saves it as Parquet (or Feather)
+    Groups are read from the cache (and downloaded if they are not there), lined up on their tract numbers,
+    limited to the tracts in tracts_csv, stored in the smallest number types that fit, and renamed with rename_dict
+
+    Inputs:
+        groups: a list of group numbers (indexes in vars_lst) to include, if None every group is included
+        out_name: the name of the file to save, ending in .parquet or .feather
+
+    Returns: the table as a pandas dataframe indexed by Tract
+    '''
+    if groups is None:
+        groups = range(len(vars_lst))
+    #the tracts in the city of Chicago, as an index so the join below is a lookup instead of a search
+    tracts = pd.read_csv(tracts_csv, usecols=['TRACTCE10']).drop_duplicates().set_index('TRACTCE10')
+    tracts.index.name = 'Tract'
+
+    df_lst = []
+    for i in groups:
+        group_df, source = get_acs(dataset, year, geo, vars_lst[i])
+        group_df['Tract'] = pd.to_numeric(group_df['tract']) #the tract numbers for the whole group at once
+        df_lst.append(group_df.set_index('Tract')[vars_lst[i]])
+    df = pd.concat(df_lst, axis=1)
+    df = df.loc[:, ~df.columns.duplicated()] #a variable in more than one group is only kept once
+    df = df.join(tracts, how='inner') #only keeps the tracts in the city of Chicago
+
+    df = shrink_numbers(df).rename(columns=rename_dict)
+    if out_name.endswith('.feather'):
+        df.reset_index().to_feather(out_name)
+    else:
+        df.to_parquet(out_name)
+    del df_lst
+    return df
+
+def shrink_numbers(df):
+    '''
+    Stores each column in the smallest number type that fits it
+    Columns of whole numbers become the smallest int that fits, other columns become float32
+
+    Inputs: df: a pandas dataframe of numbers
+
+    Returns: the pandas dataframe
+    '''
+    for col in df.columns:
+        df[col] = pd.to_numeric(df[col], downcast='integer')
+        if df[col].dtype.kind == 'f':
+            df[col] = pd.to_numeric(df[col], downcast='float')
+    return df
+
+def load_census(file_name=census_table):
+    '''
+    Loads the table saved by finalize
+
+    Inputs: file_name: the name of the file finalize saved
+
+    Returns: a pandas dataframe indexed by Tract
+    '''
+    if file_name.endswith('.feather'):
+        return pd.read_feather(file_name).set_index('Tract')
+    return pd.read_parquet(file_name)
+
+def get_variables(codes, use_cache=True, workers=max_workers, rename=False):
+    '''
+    Gets any list of variables without having to split them into groups by hand
+    Whole tables (like 'B27001') are turned into all of their estimate variables, the variables are packed into as few
+    requests as the API allows, the requests are sent at the same time, and the results are joined into one table
+
+    Example: get_variables(['B01001_001E', 'B27001', 'B19013_001E'])
+
+    Inputs:
+        codes: a list of variable codes (like 'B01001_001E') and table IDs (like 'B27001')
+        use_cache: if True, requests saved in cache_dir are used instead of being sent again
+        workers: the number of requests to send at the same time
+        rename: if True, columns get descriptive names (from rename_dict or made from the variable's label)
+
+    Returns: a pandas dataframe with one row per tract (indexed by Tract) and one column per variable
+    '''
+    variables = expand_tables(codes)
+    validate_variables(variables) #finds bad variables before we ask the API
+    chunks = chunk_variables(variables)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda chunk: retry(get_acs, dataset, year, geo, chunk, use_cache), chunks))
+
+    failed = [error for result, attempts, error in results if error]
+    if failed:
+        raise RuntimeError('%d of %d requests failed: %s' %(len(failed), len(chunks), failed))
+
+    levels = [level for level, code in geo]
+    #every request has the same tracts, so we line them up on the geography columns and put them side by side
+    df_lst = [result.set_index(levels) for (result, source), attempts, error in results]
+    df = pd.concat([df_lst[0][['NAME']]] + [df.drop(columns='NAME') for df in df_lst], axis=1)
+    df['Tract'] = df.index.get_level_values('tract').astype(int)
+    df = df.reset_index(drop=True).set_index('Tract')[['NAME'] + variables]
+    if rename:
+        df = df.rename(columns=column_names(variables))
+    return df
+
+def expand_tables(codes):
+    '''
+    Turns table IDs into the estimate variables in the table, variable codes are kept as they are
+    Duplicates are taken out and the order is kept
+
+    Inputs: codes: a list of variable codes and table IDs
+
+    Returns: a list of variable codes
+    '''
+    variables = []
+    for code in codes:
+        if '_' in code: #variable codes look like B01001_001E, table IDs have no underscore
+            variables.append(code)
+        else:
+            variables.extend(table_variables(code))
+    return list(dict.fromkeys(variables))
+
+def table_variables(table):
+    '''
+    Gets the estimate variables in a table from the local list of variables
+
+    Inputs: table: a table ID like 'B27001'
+
+    Returns: a sorted list of variable codes
+    '''
+    load_variables()
+    if table not in tables_index:
+        raise ValueError(table + ' is not a table in ' + dataset + ' ' + str(year))
+    return tables_index[table]
+
+def load_variables(api=None, refresh=False):
+    '''
+    Loads the list of every variable and builds the lookup tables used to search and check variables
+    The list is downloaded once and saved to variables_json, after that it is read from the file
+
+    Inputs:
+        api: the url of the census API, if None census_api_url is used
+        refresh: if True, the list is downloaded again
+
+    Returns: the variables_index dictionary
+    '''
+    global variables_index, words_index, tables_index
+    if variables_index is not None and not refresh:
+        return variables_index
+
+    if refresh or not os.path.exists(variables_json):
+        req = requests.get('%s/%s/acs/%s/variables.json' %(api or census_api_url, year, dataset), timeout=120)
+        req.raise_for_status()
+        with open(variables_json, 'w') as f:
+            f.write(req.text)
+    with open(variables_json) as f:
+        raw = json.load(f)['variables']
+
+    variables, words, tables = {}, {}, {}
+    for code, info in raw.items():
+        variables[code] = {'label': info.get('label', ''), 'concept': info.get('concept', ''),
+            'table': info.get('group', 'N/A'), 'predicate_only': info.get('predicateOnly', False)}
+        text = ' '.join([code, variables[code]['table'], variables[code]['label'], variables[code]['concept']])
+        for word in re.findall(r'\w+', text.lower()): #codes and table IDs are words too, so they can be searched for
+            words.setdefault(word, set()).add(code)
+        if code.endswith('E') and variables[code]['table'] != 'N/A':
+            tables.setdefault(variables[code]['table'], []).append(code)
+    for table in tables:
+        tables[table].sort()
+
+    variables_index, words_index, tables_index = variables, words, tables
+    return variables_index
+
+def search_variables(text):
+    '''
+    Finds the estimate variables whose code, table ID, label, or concept has every word in text
+
+    Examples: search_variables('health insurance female 19 to 25'), search_variables('B27001'), search_variables('B27001 female')
+
+    Inputs: text: the words to search for
+
+    Returns: a pandas dataframe of the matching variables with their label, concept, and table, indexed by code
+    '''
+    load_variables()
+    words = re.findall(r'\w+', text.lower())
+    codes = set.intersection(*[words_index.get(word, set()) for word in words]) if words else set()
+    codes = sorted(code for code in codes if code.endswith('E'))
+    return pd.DataFrame([variables_index[code] for code in codes], index=codes, columns=['label', 'concept', 'table'])
+
+def validate_variables(codes, allow_moe=False):
+    '''
+    Checks a list of variables against the local list of variables, without asking the API
+    A variable is bad if:
+        it does not exist
+        it is a margin of error (ends in M) or an annotation (ends in EA or MA) and allow_moe is False
+        it is not in a detailed table (B or C tables are the ones the API has for tracts)
+        it is only used to filter requests (like 'for' or 'in') instead of holding data
+
+    Inputs:
+        codes: a list of variable codes
+        allow_moe: if True, margins of error are allowed
+
+    Returns: None, raises a ValueError listing every bad variable if there are any
+    '''
+    load_variables()
+    problems = []
+    for code in codes:
+        info = variables_index.get(code)
+        if info is None:
+            problems.append(code + ': does not exist in ' + dataset + ' ' + str(year))
+        elif code.endswith(('EA', 'MA')):
+            problems.append(code + ': is an annotation, not a number')
+        elif code.endswith('M') and not allow_moe:
+            problems.append(code + ': is a margin of error, the estimate is ' + code[:-1] + 'E')
+        elif info['predicate_only']:
+            problems.append(code + ': can only be used to filter requests')
+        elif not info['table'].startswith(('B', 'C')):
+            problems.append(code + ': is not in a detailed table, so it is not available for tracts')
+    if problems:
+        raise ValueError('Bad variables:\n' + '\n'.join(problems))
+
+def column_names(codes):
+    '''
+    Creates descriptive column names for variables
+    Names in rename_dict are used if they are there, otherwise the name is made from the variable's label
+    e.g. B01001_003E, "Estimate!!Total!!Male!!Under 5 years", becomes Male_Under_5_years
+
+    Inputs: codes: a list of variable codes
+
+    Returns: a dictionary of code: column name
+    '''
+    load_variables()
+    names = {}
+    used = set(rename_dict.values())
+    for code in codes:
+        if code in rename_dict:
+            names[code] = rename_dict[code]
+            continue
+        info = variables_index.get(code, {'label': '', 'concept': ''})
+        parts = [part for part in info['label'].split('!!') if part not in ('Estimate', 'Margin of Error', 'Total', 'Total:')]
+        if not parts: #totals have nothing but 'Estimate!!Total', so we use the name of the table instead
+            parts = ['Total', info['concept'].title()]
+        name = '_'.join(re.sub(r'[\s:,]+', '_', part.strip(' :')) for part in parts).strip('_')
+        if not name or name in used: #two variables cannot have the same name
+            name = (name + '_' + code).strip('_')
+        names[code] = name
+        used.add(name)
+    return names
+
+def chunk_variables(variables, size=max_vars_per_request):
+    '''
+    Splits variables into as few requests as the API allows
+    The variables are sorted first so variables from the same table are in the same request,
+    which means adding a variable to a table does not change every request (and every saved copy in the cache)
+
+    Inputs:
+        variables: a list of variable codes
+        size: the most variables in one request
+
+    Returns: a list of lists of variable codes
+    '''
+    variables = sorted(variables)
+    return [variables[start:start + size] for start in range(0, len(variables), size)]
+
+def get_acs(dataset, year, geo, variables, use_cache=True):
+    '''
+    Gets variables from the census API, using the copy saved in cache_dir if it is there and not too old
+    Each saved copy is a Parquet file named after a hash of (dataset, year, geography, variables)
+
+    Inputs:
+        dataset: the census dataset, e.g. 'acs5'
+        year: the year of the data
+        geo: a list of (geography level, code) like geo above
+        variables: a list of variable codes
+        use_cache: if False, the data is always downloaded (and the saved copy is replaced)
+
+    Returns:
+        a pandas dataframe with a column for every geography level, NAME, and every variable
+        'cache' or 'api' depending on where the data came from
+    '''
+    cache_name = cache_path(dataset, year, geo, variables)
+    if use_cache and is_cached(dataset, year, geo, variables):
+        return pd.read_parquet(cache_name), 'cache'
+
+    df = fetch_acs(dataset, year, geo, variables)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_name = cache_name + '.tmp'
+    df.to_parquet(tmp_name, index=False) #writes to a new file first so a crash cannot leave half a file
+    os.replace(tmp_name, cache_name)
+    return df, 'api'
+
+def cache_path(dataset, year, geo, variables):
+    '''
+    Inputs: the same as get_acs
+
+    Returns: the name of the file in cache_dir the variables are saved in
+    '''
+    key = json.dumps([dataset, year, geo, sorted(variables)])
+    return os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest()[:24] + '.parquet')
+
+def is_cached(dataset, year, geo, variables):
+    '''
+    Checks if variables are saved in cache_dir and not older than cache_max_age
+
+    Inputs: the same as get_acs
+
+    Returns: True if get_acs would use the saved copy
+    '''
+    cache_name = cache_path(dataset, year, geo, variables)
+    return os.path.exists(cache_name) and time.time() - os.path.getmtime(cache_name) < cache_max_age
+
+def fetch_acs(dataset, year, geo, variables, api=None):
+    '''
+    Downloads variables from the census API
+
+    Inputs:
+        dataset: the census dataset, e.g. 'acs5'
+        year: the year of the data
+        geo: a list of (geography level, code), the last one is what we want a row for and the others are what it is in
+        variables: a list of variable codes
+        api: the url of the census API, if None census_api_url is used (read when the request is sent, so it can be changed for testing)
+
+    Returns: a pandas dataframe with a column for every geography level, NAME, and every variable
+    '''
+    params = {'get': ','.join(['NAME'] + list(variables)),
+        'for': '%s:%s' %geo[-1],
+        'in': ' '.join('%s:%s' %level for level in geo[:-1])}
+    req = requests.get('%s/%s/acs/%s' %(api or census_api_url, year, dataset), params=params, timeout=120)
+    req.raise_for_status() #raises an error if the API did not work, so download_with_retries tries again
+    rows = req.json()
+
+    df = pd.DataFrame(rows[1:], columns=rows[0]) #the first row is the column names
+    for var in variables:
+        df[var] = pd.to_numeric(df[var], errors='coerce')
+    return df
+
+def to_censusgeo_index(df):
+    '''
+    Turns the geography columns into a censusgeo index, the same index censusdata.download gives
+
+    Inputs: df: a pandas dataframe from fetch_acs
+
+    Returns: the dataframe with a censusgeo index and without the geography and NAME columns
+    '''
+    levels = [level for level, code in geo]
+    df.index = [censusdata.censusgeo([(level, row[level]) for level in levels], row['NAME'])
+        for row in df[levels + ['NAME']].to_dict('records')]
+    return df.drop(columns=levels + ['NAME'])
+
+if __name__ == '__main__':
+    go()
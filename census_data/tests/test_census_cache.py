@@ -0,0 +1,173 @@
+'''
+Tests the census_cache (and the variable list) against a local server that stands in for the census API
+
+Run from census_data with: python -m pytest tests
+'''
+import json
+import os
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import census_api
+
+#The variables the stand-in server knows about
+variables = {
+    'B01001_001E': {'label': 'Estimate!!Total', 'concept': 'SEX BY AGE', 'group': 'B01001'},
+    'B01001_002E': {'label': 'Estimate!!Total!!Male', 'concept': 'SEX BY AGE', 'group': 'B01001'},
+    'B19013_001E': {'label': 'Estimate!!Median household income', 'concept': 'MEDIAN HOUSEHOLD INCOME', 'group': 'B19013'},
+}
+tracts = ['010100', '010200', '990000'] #the last one is not in the city of Chicago
+
+class CensusHandler(BaseHTTPRequestHandler):
+    '''
+    Answers variables.json and data requests the way the census API does
+    Requests for a variable in self.server.failing (or for variables.json if it is in there) get a 500 error
+    '''
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/data/2017/acs/acs5/variables.json':
+            if 'variables.json' in self.server.failing:
+                self.send_error(500)
+            else:
+                self.send_json({'variables': variables})
+            return
+        if url.path != '/data/2017/acs/acs5':
+            self.send_error(404)
+            return
+
+        params = parse_qs(url.query)
+        codes = params['get'][0].split(',')
+        self.server.requested.append(codes)
+        if self.server.failing.intersection(codes):
+            self.send_error(500)
+            return
+        assert params['for'] == ['tract:*'] and params['in'] == ['state:17 county:031']
+        rows = [codes + ['state', 'county', 'tract']]
+        for tract in tracts:
+            values = [str(int(tract) + n) for n in range(1, len(codes))]
+            rows.append(['Census Tract ' + tract] + values + ['17', '031', tract])
+        self.send_json(rows)
+
+    def send_json(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server(monkeypatch):
+    '''
+    Starts the stand-in server and points census_api at it
+    '''
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), CensusHandler)
+    httpd.requested = []
+    httpd.failing = set()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(census_api, 'census_api_url', 'http://127.0.0.1:{}/data'.format(httpd.server_address[1]))
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+@pytest.fixture(autouse=True)
+def run_dir(tmp_path, monkeypatch):
+    '''
+    Runs each test in its own folder with an empty cache and two small groups of variables
+    '''
+    monkeypatch.chdir(tmp_path)
+    pd.DataFrame({'TRACTCE10': [10100, 10200]}).to_csv(census_api.tracts_csv, index=False)
+    monkeypatch.setattr(census_api, 'vars_lst', [['B01001_001E', 'B01001_002E'], ['B19013_001E']])
+    monkeypatch.setattr(census_api, 'group_names', ['people', 'income'])
+    monkeypatch.setattr(census_api, 'variables_index', None)
+    monkeypatch.setattr(census_api, 'max_retries', 0)
+    return tmp_path
+
+def cache_files():
+    return sorted(name for name in os.listdir(census_api.cache_dir) if name.endswith('.parquet'))
+
+def test_cache_hit(server):
+    df, source = census_api.get_acs('acs5', 2017, census_api.geo, ['B01001_001E'])
+    assert source == 'api'
+    assert df['B01001_001E'].tolist() == [10101, 10201, 990001]
+
+    cached_df, source = census_api.get_acs('acs5', 2017, census_api.geo, ['B01001_001E'])
+    assert source == 'cache'
+    assert len(server.requested) == 1
+    pd.testing.assert_frame_equal(cached_df, df)
+
+def test_cache_key_has_variable_set(server):
+    census_api.get_acs('acs5', 2017, census_api.geo, ['B01001_001E'])
+    df, source = census_api.get_acs('acs5', 2017, census_api.geo, ['B01001_001E', 'B01001_002E'])
+    assert source == 'api'
+    assert len(cache_files()) == 2
+
+def test_cache_expired(server):
+    census_api.get_acs('acs5', 2017, census_api.geo, ['B01001_001E'])
+    old = time.time() - census_api.cache_max_age - 1
+    for name in cache_files():
+        os.utime(os.path.join(census_api.cache_dir, name), (old, old))
+
+    df, source = census_api.get_acs('acs5', 2017, census_api.geo, ['B01001_001E'])
+    assert source == 'api'
+    assert len(server.requested) == 2
+
+def test_use_cache_false(server):
+    census_api.get_acs('acs5', 2017, census_api.geo, ['B01001_001E'])
+    df, source = census_api.get_acs('acs5', 2017, census_api.geo, ['B01001_001E'], use_cache=False)
+    assert source == 'api'
+    assert len(server.requested) == 2
+
+def test_go_resumes_missing_groups(server):
+    server.failing = {'B19013_001E'}
+    report = census_api.go(workers=2)
+    assert report['Status'].tolist() == ['ok', 'failed']
+    assert not os.path.exists(census_api.census_table) #nothing is put together until every group worked
+
+    server.failing = set()
+    server.requested.clear()
+    report = census_api.go(workers=2)
+    assert report['Status'].tolist() == ['ok', 'ok']
+    assert report['Source'].tolist() == ['cache', 'api']
+    assert server.requested == [['NAME', 'B19013_001E']] #only the group that failed is downloaded again
+
+    df = census_api.load_census()
+    assert df.index.tolist() == [10100, 10200]
+    assert df[census_api.rename_dict.get('B19013_001E', 'B19013_001E')].tolist() == [10101, 10201]
+
+def test_go_without_variable_list(server):
+    server.failing = {'variables.json'} #the groups are still downloaded, they are just not checked first
+    report = census_api.go(workers=2)
+    assert report['Status'].tolist() == ['ok', 'ok']
+
+def test_search_variables(server):
+    assert census_api.search_variables('B01001').index.tolist() == ['B01001_001E', 'B01001_002E']
+    assert census_api.search_variables('b01001_002e').index.tolist() == ['B01001_002E']
+    assert census_api.search_variables('sex male').index.tolist() == ['B01001_002E']
+    assert census_api.search_variables('B19013 male').empty
+
+def test_go_downloads_other_expired_groups(server):
+    census_api.go(workers=2)
+    old = time.time() - census_api.cache_max_age - 1
+    os.utime(census_api.cache_path('acs5', 2017, census_api.geo, census_api.vars_lst[0]), (old, old))
+
+    server.failing = {'B01001_001E'} #the expired group fails, which is reported instead of crashing go
+    report = census_api.go(groups=[1], workers=2)
+    assert report.index.tolist() == [1, 0]
+    assert report['Status'].tolist() == ['ok', 'failed']
+
+    server.failing = set()
+    report = census_api.go(groups=[1], workers=2)
+    assert report['Status'].tolist() == ['ok', 'ok']
+    assert report['Source'].tolist() == ['cache', 'api']